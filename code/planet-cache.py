@@ -12,16 +12,37 @@ __license__ = "Python"
 import os
 import sys
 import time
-import dbhash
 import ConfigParser
 
+try:
+    import dbhash
+except:
+    dbhash = None
+
 import planet
 
 
+# Errors from a cache file or database that's damaged or isn't one
+CACHE_ERRORS = ()
+if dbhash is not None:
+    CACHE_ERRORS += (dbhash.bsddb._db.DBError,)
+if planet.cache.sqlite3 is not None:
+    CACHE_ERRORS += (planet.cache.sqlite3.DatabaseError,)
+
+# Said when a dbhash file needs reading without the module to read it
+NO_DBHASH = "Reading dbhash cache files needs the bsddb module"
+
+
 def usage():
     print "Usage: planet-cache [options] CACHEFILE [ITEMID]..."
+    print "       planet-cache [options] DATABASE URL [ITEMID]..."
+    print "       planet-cache --vacuum CACHEFILE|DATABASE..."
+    print "       planet-cache --export|--import SNAPSHOT CACHEDIR|DATABASE"
+    print "       planet-cache --migrate [--jobs=N] CACHEDIR DATABASE"
     print
-    print "Examine and modify information in the Planet cache."
+    print "Examine and modify information in the Planet cache, either a"
+    print "channel's CACHEFILE or the channel with the given URL in a SQLite"
+    print "cache DATABASE."
     print
     print "Channel Commands:"
     print " -C, --channel     Display known information on the channel"
@@ -33,6 +54,19 @@ def usage():
     print " -H, --hide        Mark the item(s) as hidden"
     print " -U, --unhide      Mark the item(s) as not hidden"
     print
+    print "Cache Commands:"
+    print " -V, --vacuum      Rewrite the cache file(s) compactly, giving back"
+    print "                   the space of removed items and of item bodies"
+    print "                   no longer used"
+    print " --export          Write every channel in the cache directory or"
+    print "                   database into the SNAPSHOT file"
+    print " --import          Read the channels in the SNAPSHOT file into the"
+    print "                   cache directory or database"
+    print " --migrate         Copy the channels in the dbhash files in the cache"
+    print "                   directory into the SQLite DATABASE, checking each;"
+    print "                   run it again to carry on after an interruption"
+    print " --jobs=N          Read N files at a time when migrating"
+    print
     print "Other Options:"
     print " -h, --help        Display this help message and exit"
     sys.exit(0)
@@ -62,12 +96,160 @@ def fit_str(string, length):
         return string[:length-4] + " ..."
 
 
+def is_sqlite(filename):
+    try:
+        return open(filename, "rb").read(16) == "SQLite format 3\0"
+    except IOError:
+        return 0
+
+def error_message(e):
+    # Berkeley DB errors come with their number first
+    if len(e.args) > 1:
+        return e.args[1]
+    return str(e)
+
+def forget_render_index(directory):
+    # Offline runs would still render the items as they were
+    try:
+        os.remove(os.path.join(directory, planet.RENDER_INDEX_FILE))
+    except OSError:
+        pass
+
+def vacuum(filenames):
+    reclaimed = 0
+    directories = {}
+    for filename in filenames:
+        if not os.path.isfile(filename):
+            print >>sys.stderr, filename + ": No such file"
+            continue
+
+        if dbhash is None and not is_sqlite(filename):
+            print >>sys.stderr, filename + ":", NO_DBHASH
+            continue
+
+        before = os.path.getsize(filename)
+        try:
+            if is_sqlite(filename):
+                store = planet.cache.SQLiteStore(filename)
+            else:
+                store = planet.cache.DBHashStore(filename)
+                directories[os.path.dirname(filename)] = 1
+            store.vacuum()
+            store.close()
+        except CACHE_ERRORS, e:
+            print >>sys.stderr, filename + ":", error_message(e)
+            continue
+        after = os.path.getsize(filename)
+
+        print "%s: %d to %d bytes" % (filename, before, after)
+        reclaimed += before - after
+
+    for directory in directories.keys():
+        reclaimed += vacuum_bodies(directory)
+
+    print "Reclaimed %d kilobytes." % (reclaimed / 1024)
+
+def vacuum_bodies(directory):
+    bodies = planet.cache.body_store(directory)
+    if not os.path.isfile(bodies.filename):
+        return 0
+
+    # Wait for any run using the cache to finish, it stores bodies before
+    # the items referring to them
+    bodies.close()
+    lock = planet.cache.lock(os.path.join(directory, planet.RUN_LOCK_FILE))
+    before = os.path.getsize(bodies.filename)
+    removed = planet.cache.sweep_bodies(directory)
+    bodies.vacuum()
+    bodies.close()
+    after = os.path.getsize(bodies.filename)
+
+    print "%s: %d to %d bytes, %d unused bodies removed" % (
+        bodies.filename, before, after, removed)
+    return before - after
+
+def export_snapshot(snapshot, cache):
+    if os.path.isdir(cache):
+        files = dict(planet.cache.channel_files(cache))
+        items = planet.cache.export_snapshot(snapshot, files.keys(),
+            lambda url: planet.cache.DBHashStore(files[url], "r"))
+        channels = len(files)
+    elif is_sqlite(cache):
+        store = planet.cache.SQLiteStore(cache)
+        urls = store.urls()
+        items = planet.cache.export_snapshot(snapshot, urls, store.channel)
+        channels = len(urls)
+        store.close()
+    else:
+        print >>sys.stderr, cache + ": Not a cache directory or database"
+        sys.exit(1)
+
+    print "Exported %d channels, %d items." % (channels, items)
+
+def import_snapshot(snapshot, cache):
+    if os.path.isdir(cache):
+        directory = cache
+    else:
+        directory = os.path.dirname(cache)
+    # Wait for any run using the cache to finish
+    lock = planet.cache.lock(os.path.join(directory, planet.RUN_LOCK_FILE))
+
+    try:
+        if os.path.isdir(cache):
+            channels, items = planet.cache.import_snapshot(snapshot,
+                lambda url: planet.cache.DBHashStore(
+                    planet.cache.filename(cache, url)))
+        else:
+            # Only committed, by close(), if the whole snapshot was read
+            store = planet.cache.SQLiteStore(cache)
+            channels, items = planet.cache.import_snapshot(snapshot,
+                                                           store.channel)
+            store.close()
+    except (IOError, ValueError), e:
+        print >>sys.stderr, snapshot + ":", e
+        sys.exit(1)
+
+    planet.cache.flush()
+    forget_render_index(directory)
+
+    print "Imported %d channels, %d items." % (channels, items)
+
+def migrate(directory, database, jobs):
+    if not os.path.isdir(directory):
+        print >>sys.stderr, directory + ": Not a cache directory"
+        sys.exit(1)
+    if os.path.exists(database) and not is_sqlite(database):
+        print >>sys.stderr, database + ": Not a SQLite cache database"
+        sys.exit(1)
+    if dbhash is None:
+        print >>sys.stderr, NO_DBHASH
+        sys.exit(1)
+    # Wait for any run using the cache to finish
+    lock = planet.cache.lock(os.path.join(directory, planet.RUN_LOCK_FILE))
+
+    store = planet.cache.SQLiteStore(database)
+    try:
+        channels, items, failed = planet.cache.migrate(directory, store, jobs)
+    finally:
+        store.close()
+
+    for url, reason in failed:
+        print >>sys.stderr, url + ":", reason
+    print "Migrated %d channels, %d items." % (channels, items)
+    if failed:
+        print >>sys.stderr, "%d channels not migrated, run again to retry them." \
+              % len(failed)
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     cache_file = None
+    url = None
     want_ids = 0
-    ids = []
+    args = []
 
     command = None
+    jobs = 1
 
     for arg in sys.argv[1:]:
         if arg == "-h" or arg == "--help":
@@ -99,36 +281,94 @@ if __name__ == "__main__":
                 usage_error("Only one command option may be supplied")
             command = "unhide"
             want_ids = 1
+        elif arg == "-V" or arg == "--vacuum":
+            if command is not None:
+                usage_error("Only one command option may be supplied")
+            command = "vacuum"
+        elif arg == "--export" or arg == "--import":
+            if command is not None:
+                usage_error("Only one command option may be supplied")
+            command = arg[2:]
+        elif arg == "--migrate":
+            if command is not None:
+                usage_error("Only one command option may be supplied")
+            command = "migrate"
+        elif arg.startswith("--jobs="):
+            try:
+                jobs = int(arg[7:])
+            except ValueError:
+                usage_error("Expected a number of jobs:", arg)
         elif arg.startswith("-"):
             usage_error("Unknown option:", arg)
         else:
-            if cache_file is None:
-                cache_file = arg
-            elif want_ids:
-                ids.append(arg)
-            else:
-                usage_error("Unexpected extra argument:", arg)
+            args.append(arg)
 
-    if cache_file is None:
+    if not len(args):
         usage_error("Missing expected cache filename")
-    elif want_ids and not len(ids):
+    if command == "vacuum":
+        vacuum(args)
+        sys.exit(0)
+    elif command == "export" or command == "import":
+        if len(args) != 2:
+            usage_error("Expected a snapshot file and cache")
+        if command == "export":
+            export_snapshot(args[0], args[1])
+        else:
+            import_snapshot(args[0], args[1])
+        sys.exit(0)
+    elif command == "migrate":
+        if len(args) != 2:
+            usage_error("Expected a cache directory and database")
+        migrate(args[0], args[1], jobs)
+        sys.exit(0)
+    cache_file = args.pop(0)
+    if is_sqlite(cache_file):
+        if not len(args):
+            usage_error("Missing expected channel URL")
+        url = args.pop(0)
+    ids = args
+    if want_ids and not len(ids):
         usage_error("Missing expected entry ids")
+    elif not want_ids and len(ids):
+        usage_error("Unexpected extra argument:", ids[0])
 
-    # Open the cache file directly to get the URL it represents
-    try:
-        db = dbhash.open(cache_file)
-        url = db["url"]
-        db.close()
-    except dbhash.bsddb._db.DBError, e:
-        print >>sys.stderr, cache_file + ":", e.args[1]
-        sys.exit(1)
-    except KeyError:
-        print >>sys.stderr, cache_file + ": Probably not a cache file"
-        sys.exit(1)
+    if url is not None:
+        # Check the database has the channel, rather than add it
+        try:
+            store = planet.cache.SQLiteStore(cache_file)
+            urls = store.urls()
+            store.close()
+        except CACHE_ERRORS, e:
+            print >>sys.stderr, cache_file + ":", error_message(e)
+            sys.exit(1)
+        if url not in urls:
+            print >>sys.stderr, url + ": Not in " + cache_file
+            sys.exit(1)
+    else:
+        # Open the cache file directly to get the URL it represents
+        if dbhash is None:
+            print >>sys.stderr, cache_file + ":", NO_DBHASH
+            sys.exit(1)
+        try:
+            db = dbhash.open(cache_file)
+            url = db["url"]
+            db.close()
+        except CACHE_ERRORS, e:
+            print >>sys.stderr, cache_file + ":", error_message(e)
+            sys.exit(1)
+        except KeyError:
+            print >>sys.stderr, cache_file + ": Probably not a cache file"
+            sys.exit(1)
 
     # Now do it the right way :-)
     my_planet = planet.Planet(ConfigParser.ConfigParser())
     my_planet.cache_directory = os.path.dirname(cache_file)
+    if is_sqlite(cache_file):
+        my_planet.cache_backend = "sqlite"
+        my_planet.cache_database = os.path.basename(cache_file)
+    if command == "hide" or command == "unhide":
+        # Wait for any run using the cache to finish
+        my_planet.lock_cache()
     channel = planet.Channel(my_planet, url)
 
     for item_id in ids:
@@ -180,6 +420,8 @@ if __name__ == "__main__":
                 item.hidden = "yes"
 
         channel.cache_write()
+        my_planet.cache_flush()
+        forget_render_index(my_planet.cache_directory)
         print "Done."
 
     elif command == "unhide":
@@ -191,4 +433,6 @@ if __name__ == "__main__":
                 print item_id + ": Not hidden."
 
         channel.cache_write()
+        my_planet.cache_flush()
+        forget_render_index(my_planet.cache_directory)
         print "Done."
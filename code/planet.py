@@ -143,7 +143,8 @@ def main():
 
     # run the planet
     my_planet = planet.Planet(config)
-    my_planet.run(planet_name, planet_link, template_files, offline)
+    if not my_planet.run(planet_name, planet_link, template_files, offline):
+        return
 
     my_planet.generate_all_files(template_files, planet_name,
         planet_link, planet_feed, owner_name, owner_email)
@@ -32,7 +32,6 @@ __all__ = ("cache", "feedparser", "htmltmpl", "logging",
 import os
 import md5
 import time
-import dbhash
 import re
 
 try: 
@@ -50,9 +49,45 @@ USER_AGENT = VERSION + " " + feedparser.USER_AGENT
 # Default cache directory
 CACHE_DIRECTORY = "cache"
 
+# Default cache backend: "dbhash" for a file per channel, or "sqlite" for
+# a single database file within the cache directory
+CACHE_BACKEND = "dbhash"
+CACHE_DATABASE = "planet.db"
+
+# File within the cache directory locked by each run, and what a run does
+# when another has it: "wait" for that run to finish, or "skip" this one
+RUN_LOCK_FILE = ".lock"
+RUN_LOCK = "wait"
+
+# Default limits on what's kept in the cache for each channel: the number
+# of items, their age in days and the kilobytes they take, 0 for no limit
+CACHE_MAX_ITEMS = 0
+CACHE_MAX_DAYS = 0
+CACHE_MAX_SIZE = 0
+
 # Default number of items to display from a new feed
 NEW_FEED_ITEMS = 10
 
+# Directory within the cache directory to keep parsed feeds in, and the
+# number of days they're kept unused
+PARSE_CACHE_DIRECTORY = ".parsed"
+PARSE_CACHE_DAYS = 7
+
+# File within the cache directory to keep sanitized HTML in, and its
+# default maximum size in kilobytes
+HTML_CACHE_FILE = ".sanitized"
+HTML_CACHE_SIZE = 16384
+
+# File within the cache directory listing the items to render, written by
+# each run that updates the channels for those that don't
+RENDER_INDEX_FILE = ".rendered"
+
+# Version of the information NewsItem.update derives from an entry
+ENTRY_FORMAT = "3"
+
+# Number of words of an item's content to keep as its plain text excerpt
+EXCERPT_WORDS = 50
+
 # Useful common date/time formats
 TIMEFMT_ISO = "%Y-%m-%dT%H:%M:%S+00:00"
 TIMEFMT_822 = "%a, %d %b %Y %H:%M:%S +0000"
@@ -65,6 +100,34 @@ try:
 except:
     log.warning = log.warn
 
+# Counters of the work done during a run, logged by report_metrics()
+metrics = {}
+
+def count(name, value=1):
+    """Add value to the named run metric."""
+    metrics[name] = metrics.get(name, 0) + value
+
+def report_metrics():
+    """Log the run metrics gathered by us and by feedparser."""
+    log = logging.getLogger("planet.runner")
+    report = metrics.copy()
+    # Blocks Planet.sanitize() looked at for relative URIs, plus those
+    # feedparser resolved itself when it had no html_processor
+    report["html_blocks_resolved"] = report.get("html_blocks_resolved", 0) \
+                                     + feedparser.RESOLVE_STATS["parsed"]
+    report["html_blocks_fast_path"] = report.get("html_blocks_fast_path", 0) \
+                                      + feedparser.RESOLVE_STATS["fast"]
+    report["cache_records_written"] = cache.WRITE_STATS["written"]
+    report["cache_bytes_written"] = cache.WRITE_STATS["written_bytes"]
+    report["cache_records_unchanged"] = cache.WRITE_STATS["unchanged"]
+    report["cache_bytes_unchanged"] = cache.WRITE_STATS["unchanged_bytes"]
+
+    names = report.keys()
+    names.sort()
+    log.info("Run metrics:")
+    for name in names:
+        log.info("    %-24s %d", name, report[name])
+
 # Defaults for the template file config sections
 ENCODING        = "utf-8"
 ITEMS_PER_PAGE  = 60
@@ -78,11 +141,54 @@ class stripHtml(sgmllib.SGMLParser):
     "remove all tags from the data"
     def __init__(self, data):
         sgmllib.SGMLParser.__init__(self)
-        self.result=''
+        self.pieces=[]
         self.feed(data)
         self.close()
+        self.result=''.join(self.pieces)
     def handle_data(self, data):
-        if data: self.result+=data
+        if data: self.pieces.append(data)
+
+class stripBlocks(stripHtml):
+    "remove all tags from the data, keeping the words of separate blocks apart"
+    breaks = ("address", "blockquote", "br", "dd", "div", "dl", "dt",
+              "h1", "h2", "h3", "h4", "h5", "h6", "hr", "li", "ol", "p",
+              "pre", "table", "td", "th", "tr", "ul")
+    def unknown_starttag(self, tag, attrs):
+        if tag in self.breaks: self.pieces.append(' ')
+    def unknown_endtag(self, tag):
+        if tag in self.breaks: self.pieces.append(' ')
+
+def plain_text(html, parser=stripHtml):
+    """Return the text of the HTML with the markup removed."""
+    try:
+        return parser(html).result
+    except sgmllib.SGMLParseError:
+        return ""
+
+def canonical(value):
+    """Return a stable string representation of a feedparser value.
+
+    Dictionaries are written with their keys sorted so that two equal
+    entries always produce the same string, whatever order feedparser
+    happened to fill them in.
+    """
+    if isinstance(value, dict):
+        items = value.items()
+        items.sort()
+        return "{" + ",".join([ repr(k) + ":" + canonical(v)
+                                for k, v in items ]) + "}"
+    elif isinstance(value, (list, tuple)):
+        return "[" + ",".join([ canonical(v) for v in value ]) + "]"
+    else:
+        return repr(value)
+
+def fingerprint(entry):
+    """Return a fingerprint of the raw feedparser entry.
+
+    ENTRY_FORMAT is mixed in so that changing what NewsItem.update stores
+    invalidates every fingerprint and the entries are processed again.
+    """
+    return md5.new(ENTRY_FORMAT + canonical(entry)).hexdigest()
 
 def template_info(item, date_format):
     """Produce a dictionary of template information."""
@@ -95,7 +201,8 @@ def template_info(item, date_format):
             info[key + "_822"] = time.strftime(TIMEFMT_822, date)
         else:
             info[key] = item[key]
-    if 'title' in item.keys():
+    if 'title' in item.keys() and 'title_plain' not in item.keys():
+        # Only items cached before NewsItem.update stored it
         info['title_plain'] = stripHtml(info['title']).result
 
     return info
@@ -110,6 +217,18 @@ class Planet:
     Properties:
         user_agent      User-Agent header to fetch feeds with.
         cache_directory Directory to store cached channels in.
+        cache_backend   How to store cached channels, "dbhash" or "sqlite".
+        cache_database  File within cache_directory for the "sqlite" backend.
+        cache_max_items Most items to keep cached for each channel.
+        cache_max_days  Most days to keep a cached item for.
+        cache_max_size  Most kilobytes of items to keep cached for a channel.
+        run_lock        "wait" or "skip" when another run has the cache.
+        parse_cache     Cache of parsed feeds, or None when offline.
+        html_cache      Cache of sanitized HTML, or None when offline or
+                        without the bsddb module.
+        html_policy     Elements and attributes let through sanitized HTML.
+        offline         Channels are only read from the cache, not updated.
+        render_index    Index of the items to render, or None to find them.
         new_feed_items  Number of items to display from a new feed.
         filter          A regular expression that articles must match.
         exclude         A regular expression that articles must not match.
@@ -121,10 +240,24 @@ class Planet:
 
         self.user_agent = USER_AGENT
         self.cache_directory = CACHE_DIRECTORY
+        self.cache_backend = CACHE_BACKEND
+        self.cache_database = CACHE_DATABASE
+        self.cache_max_items = CACHE_MAX_ITEMS
+        self.cache_max_days = CACHE_MAX_DAYS
+        self.cache_max_size = CACHE_MAX_SIZE
+        self.run_lock = RUN_LOCK
+        self.parse_cache = None
+        self.html_cache = None
+        self.html_policy = sanitize.DEFAULT_POLICY
+        self.offline = 0
+        self.render_index = None
         self.new_feed_items = NEW_FEED_ITEMS
         self.filter = None
         self.exclude = None
 
+        self._store = None
+        self._lock = None
+
     def tmpl_config_get(self, template, option, default=None, raw=0, vars=None):
         """Get a template value from the configuration, with a default."""
         if self.config.has_option(template, option):
@@ -218,18 +351,68 @@ class Planet:
         return items_list
 
     def run(self, planet_name, planet_link, template_files, offline = False):
+        """Load the channels from the cache and update them.
+
+        Returns whether it did, which it doesn't if run_lock is "skip" and
+        another run has the cache.
+        """
         log = logging.getLogger("planet.runner")
 
         # Create a planet
         log.info("Loading cached data")
         if self.config.has_option("Planet", "cache_directory"):
             self.cache_directory = self.config.get("Planet", "cache_directory")
+        if self.config.has_option("Planet", "cache_backend"):
+            self.cache_backend = self.config.get("Planet", "cache_backend")
+        if self.config.has_option("Planet", "cache_database"):
+            self.cache_database = self.config.get("Planet", "cache_database")
+        if self.config.has_option("Planet", "cache_max_items"):
+            self.cache_max_items = int(self.config.get("Planet",
+                                                       "cache_max_items"))
+        if self.config.has_option("Planet", "cache_max_days"):
+            self.cache_max_days = int(self.config.get("Planet",
+                                                      "cache_max_days"))
+        if self.config.has_option("Planet", "cache_max_size"):
+            self.cache_max_size = int(self.config.get("Planet",
+                                                      "cache_max_size"))
+        if self.config.has_option("Planet", "run_lock"):
+            self.run_lock = self.config.get("Planet", "run_lock")
         if self.config.has_option("Planet", "new_feed_items"):
             self.new_feed_items  = int(self.config.get("Planet", "new_feed_items"))
         self.user_agent = "%s +%s %s" % (planet_name, planet_link,
                                               self.user_agent)
         if self.config.has_option("Planet", "filter"):
             self.filter = self.config.get("Planet", "filter")
+        if self.config.has_option("Planet", "allowed_elements") or \
+               self.config.has_option("Planet", "allowed_attributes"):
+            elements = attributes = None
+            if self.config.has_option("Planet", "allowed_elements"):
+                elements = self.config.get("Planet",
+                                           "allowed_elements").split()
+            if self.config.has_option("Planet", "allowed_attributes"):
+                attributes = self.config.get("Planet",
+                                             "allowed_attributes").split()
+            self.html_policy = sanitize.Policy(elements, attributes)
+        if not self.lock_cache(not offline):
+            log.warning("Another run has the cache, skipped")
+            return 0
+
+        self.offline = offline
+        if offline:
+            self.open_render_index()
+        else:
+            self.parse_cache = cache.ParseCache(
+                os.path.join(self.cache_directory, PARSE_CACHE_DIRECTORY),
+                PARSE_CACHE_DAYS * 86400)
+
+            html_cache_size = HTML_CACHE_SIZE
+            if self.config.has_option("Planet", "html_cache_size"):
+                html_cache_size = int(self.config.get("Planet",
+                                                      "html_cache_size"))
+            if cache.dbhash is not None:
+                self.html_cache = cache.HTMLCache(
+                    os.path.join(self.cache_directory, HTML_CACHE_FILE),
+                    html_cache_size * 1024)
 
         # The other configuration blocks are channels to subscribe to
         for feed_url in self.config.sections():
@@ -248,6 +431,111 @@ class Planet:
                 raise
             except:
                 log.exception("Update of <%s> failed", feed_url)
+            if not offline:
+                channel.cache_close()
+
+        if self.parse_cache is not None:
+            self.parse_cache.expire()
+            count("parse_cache_hits", self.parse_cache.hits)
+            count("parse_cache_misses", self.parse_cache.misses)
+        if self.html_cache is not None:
+            self.html_cache.close()
+            count("html_cache_hits", self.html_cache.hits)
+            count("html_cache_misses", self.html_cache.misses)
+            count("html_cache_evicted", self.html_cache.evicted)
+            self.html_cache = None
+        if not offline:
+            self.cache_flush()
+            try:
+                self.write_render_index(template_files)
+            except (IOError, OSError):
+                log.exception("Write of the render index failed")
+        report_metrics()
+        return 1
+
+    def lock_cache(self, exclusive=1):
+        """Lock the cache directory against other runs.
+
+        Runs that update the cache lock it exclusively, those that only
+        read it share the lock.  The lock is held until the planet is
+        done with.  Returns whether it was locked, which it isn't if
+        run_lock is "skip" and another run has it.
+        """
+        if self.run_lock not in ("wait", "skip"):
+            raise ValueError, "Unknown run_lock: " + self.run_lock
+        if not os.path.isdir(self.cache_directory):
+            os.makedirs(self.cache_directory)
+
+        try:
+            self._lock = cache.lock(os.path.join(self.cache_directory,
+                                                 RUN_LOCK_FILE),
+                                    exclusive, self.run_lock == "wait")
+        except IOError:
+            return 0
+        return 1
+
+    def cache_flush(self):
+        """Force everything written to the cache to disk.
+
+        Channels only sync their caches when they're written, which
+        journals the changes without waiting for them to get to the disk;
+        this makes them and forces them to disk once at the end of the
+        run.
+        """
+        if self._store is not None:
+            self._store.flush()
+        cache.flush()
+
+    def render_key(self):
+        """Return a key of the configuration the rendered items depend on."""
+        config = []
+        sections = self.config.sections()
+        sections.sort()
+        for section in sections:
+            options = self.config.options(section)
+            options.sort()
+            for option in options:
+                config.append("%s %s %s" % (section, option,
+                              self.config.get(section, option, raw=1)))
+        return md5.new(ENTRY_FORMAT + "\n" + "\n".join(config)).hexdigest()
+
+    def write_render_index(self, template_files):
+        """Write the index of the items to render for offline runs.
+
+        As many items as the template showing the most will are listed,
+        or every one if any has no limit.
+        """
+        max_items = 0
+        for template_file in template_files:
+            items_per_page = int(self.tmpl_config_get(template_file,
+                                        "items_per_page", ITEMS_PER_PAGE))
+            if not items_per_page:
+                max_items = 0
+                break
+            max_items = max(max_items, items_per_page)
+
+        items = [ (item.date_epoch(), item.order, item._channel._id, item)
+                  for item in self.items(max_items=max_items) ]
+        cache.write_render_index(os.path.join(self.cache_directory,
+                                              RENDER_INDEX_FILE),
+                                 self.render_key(), items)
+
+    def open_render_index(self):
+        """Open the render index, if it's there and for this configuration."""
+        filename = os.path.join(self.cache_directory, RENDER_INDEX_FILE)
+        if not os.path.exists(filename):
+            return
+        try:
+            index = cache.RenderIndex(filename)
+        except (IOError, ValueError), e:
+            log.warning("Ignored render index %s: %s", filename, e)
+            return
+
+        if index.key == self.render_key():
+            self.render_index = index
+        else:
+            log.info("Render index is for another configuration, ignored")
+            index.close()
 
     def generate_all_files(self, template_files, planet_name,
                 planet_link, planet_feed, owner_name, owner_email):
@@ -338,6 +626,77 @@ class Planet:
         for channel in self._channels:
             if basename == channel.cache_basename(): return channel
 
+    def sanitize(self, html, baseuri, encoding="utf-8"):
+        """Return the HTML resolved and sanitized, from html_cache if it's in there.
+
+        This is what channels have feedparser use as its html_processor,
+        so embedded HTML is only parsed once.
+        """
+        if type(html) == type(u''):
+            key = html.encode("utf-8")
+        else:
+            key = html
+        # The base URI only matters when there's something to resolve
+        if feedparser._hasRelativeURIs(key):
+            count("html_blocks_resolved")
+            key = "%s %s" % (baseuri, key)
+        else:
+            count("html_blocks_fast_path")
+            baseuri = None
+
+        if self.html_cache is None:
+            count("html_blocks_sanitized")
+            return sanitize.feed_HTML(html, baseuri, encoding,
+                                      self.html_policy)
+
+        key = md5.new("%s %s %s" % (self.sanitize_version(), encoding,
+                                    key)).hexdigest()
+
+        value = self.html_cache.get(key)
+        if value is None:
+            count("html_blocks_sanitized")
+            value = sanitize.feed_HTML(html, baseuri, encoding,
+                                       self.html_policy)
+            self.html_cache.set(key, value)
+        return value
+
+    def sanitize_version(self):
+        """Return what changes whenever sanitize()'s output does."""
+        return "%s %d %s" % (sanitize.__version__, sanitize.TIDY_MARKUP,
+                             self.html_policy.version)
+
+    def channel_cache(self, url):
+        """Return the cache store for the channel with the given URL.
+
+        The first time the SQLite backend is used the channels in the
+        dbhash files already in the cache directory are copied into it.
+        """
+        if not os.path.isdir(self.cache_directory):
+            os.makedirs(self.cache_directory)
+
+        if self.cache_backend == "dbhash":
+            filename = cache.filename(self.cache_directory, url)
+            if self.offline and os.path.exists(filename):
+                return cache.DBHashStore(filename, "r")
+            return cache.DBHashStore(filename)
+        elif self.cache_backend != "sqlite":
+            raise ValueError, "Unknown cache backend: " + self.cache_backend
+
+        if self._store is None:
+            filename = os.path.join(self.cache_directory, self.cache_database)
+            exists = os.path.exists(filename)
+            self._store = cache.SQLiteStore(filename)
+            if not exists:
+                copied, items, failed = cache.migrate(self.cache_directory,
+                                                      self._store)
+                if copied:
+                    log.info("Copied %d channels from dbhash files into %s",
+                             copied, filename)
+                for failed_url, reason in failed:
+                    log.warning("Couldn't copy <%s> from its dbhash file: %s",
+                                failed_url, reason)
+        return self._store.channel(url)
+
     def subscribe(self, channel):
         """Subscribe the planet to the channel."""
         self._channels.append(channel)
@@ -363,12 +722,13 @@ class Planet:
         If max_days is non-zero then any items older than the newest by
         this number of days won't be returned.  Requires sorted=1 to work.
 
+        When there's a render_index the items are those it lists, and the
+        channels' own items aren't read at all.
+
 
         The sharp-eyed will note that this looks a little strange code-wise,
         it turns out that Python gets *really* slow if we try to sort the
-        actual items themselves.  Also we use mktime here, but it's ok
-        because we discard the numbers and just need them to be relatively
-        consistent between each other.
+        actual items themselves.
         """
         planet_filter_re = None
         if self.filter:
@@ -377,11 +737,14 @@ class Planet:
         if self.exclude:
             planet_exclude_re = re.compile(self.exclude, re.I)
             
+        if self.render_index is not None and not hidden and not channels:
+            return self.indexed_items(max_items, max_days)
+
         items = []
         seen_guids = {}
         if not channels: channels=self.channels(hidden=hidden, sorted=0)
         for channel in channels:
-            for item in channel._items.values():
+            for item in channel._entries().values():
                 if hidden or not item.has_key("hidden"):
 
                     channel_filter_re = None
@@ -421,7 +784,7 @@ class Planet:
 
                     if not seen_guids.has_key(item.id):
                         seen_guids[item.id] = 1;
-                        items.append((time.mktime(item.date), item.order, item))
+                        items.append((item.date_epoch(), item.order, item))
 
         # Sort the list
         if sorted:
@@ -432,6 +795,31 @@ class Planet:
         if len(items) and max_items:
             items = items[:max_items]
 
+        return self.recent_items(items, max_days)
+
+    def indexed_items(self, max_items=0, max_days=0):
+        """Return the items listed by the render index.
+
+        They're read from the index, rather than the channels' caches.
+        """
+        channels = {}
+        for channel in self._channels:
+            channels[channel._id] = channel
+
+        items = []
+        for date, order, url, id_ in self.render_index.items(max_items):
+            if channels.has_key(url):
+                item = NewsItem(channels[url], id_, store=self.render_index)
+                items.append((date, order, item))
+
+        return self.recent_items(items, max_days)
+
+    def recent_items(self, items, max_days=0):
+        """Return the items of the sorted (date, order, item) list.
+
+        If max_days is non-zero then any items older than the newest by
+        this number of days aren't returned.
+        """
         # Apply max_days filter
         if len(items) and max_days:
             max_count = 0
@@ -497,20 +885,18 @@ class Channel(cache.CachedInfo):
 
     Some feeds may define additional properties to those above.
     """
+    __slots__ = ("_items", "_planet", "_expired", "_feed_items")
+
     IGNORE_KEYS = ("links", "contributors", "textinput", "cloud", "categories",
                    "url", "href", "url_etag", "url_modified", "tags", "itunes_explicit")
 
     def __init__(self, planet, url):
-        if not os.path.isdir(planet.cache_directory):
-            os.makedirs(planet.cache_directory)
-        cache_filename = cache.filename(planet.cache_directory, url)
-        cache_file = dbhash.open(cache_filename, "c", 0666)
-
-        cache.CachedInfo.__init__(self, cache_file, url, root=1)
+        cache.CachedInfo.__init__(self, planet.channel_cache(url), url, root=1)
 
-        self._items = {}
+        self._items = None
         self._planet = planet
         self._expired = []
+        self._feed_items = {}
         self.url = url
         # retain the original URL for error reporting
         self.configured_url = url
@@ -522,9 +908,11 @@ class Channel(cache.CachedInfo):
         self.last_updated = None
         self.filter = None
         self.exclude = None
-        self.next_order = "0"
+        self.next_order = 0
         self.cache_read()
-        self.cache_read_entries()
+        if self.key_type("next_order") == self.STRING:
+            # Stored as a string by older versions
+            self.next_order = int(self.next_order)
 
         if planet.config.has_section(url):
             for option in planet.config.options(url):
@@ -533,11 +921,11 @@ class Channel(cache.CachedInfo):
 
     def has_item(self, id_):
         """Check whether the item exists in the channel."""
-        return self._items.has_key(id_)
+        return self._entries().has_key(id_)
 
     def get_item(self, id_):
         """Return the item from the channel."""
-        return self._items[id_]
+        return self._entries()[id_]
 
     # Special methods
     __contains__ = has_item
@@ -545,9 +933,9 @@ class Channel(cache.CachedInfo):
     def items(self, hidden=0, sorted=0):
         """Return the item list."""
         items = []
-        for item in self._items.values():
+        for item in self._entries().values():
             if hidden or not item.has_key("hidden"):
-                items.append((time.mktime(item.date), item.order, item))
+                items.append((item.date_epoch(), item.order, item))
 
         if sorted:
             items.sort()
@@ -559,28 +947,98 @@ class Channel(cache.CachedInfo):
         """Iterate the sorted item list."""
         return iter(self.items(sorted=1))
 
+    def _entries(self):
+        """Return the dictionary of items, read when first needed."""
+        if self._items is None:
+            self._items = {}
+            self.cache_read_entries()
+        return self._items
+
     def cache_read_entries(self):
-        """Read entry information from the cache."""
-        keys = self._cache.keys()
-        for key in keys:
-            if key.find(" ") != -1: continue
+        """Read entry information from the cache.
+
+        Only the NewsItem.INDEX_KEYS of each item are read, the rest of an
+        item is read when it's needed.  This is done the first time the
+        items are, so channels that are only rendered from a render index
+        never read them.
+        """
+        for key, records in self._cache.read_items(NewsItem.INDEX_KEYS):
             if self.has_key(key): continue
 
-            item = NewsItem(self, key)
+            item = NewsItem(self, key, records)
             self._items[key] = item
 
+    def cache_close(self):
+        """Close the channel's cache until it's next needed.
+
+        Channels are updated one after another, closing each when it's
+        done keeps the number of cache files open down.
+        """
+        self._cache.close()
+
     def cache_basename(self):
         return cache.filename('',self._id)
 
     def cache_write(self, sync=1):
-        """Write channel and item information to the cache."""
-        for item in self._items.values():
-            item.cache_write(sync=0)
+        """Write channel and item information to the cache.
+
+        Items that haven't changed aren't written, and those beyond the
+        planet's cache limits are removed.  Returns whether anything was.
+        """
+        written = 0
+        for item in (self._items or {}).values():
+            if item.cache_write(sync=0):
+                written = 1
+        self.expire_items()
         for item in self._expired:
             item.cache_clear(sync=0)
-        cache.CachedInfo.cache_write(self, sync)
+            written = 1
+        if cache.CachedInfo.cache_write(self, sync=0):
+            written = 1
+        if sync and written:
+            self._cache.sync()
 
         self._expired = []
+        return written
+
+    def expire_items(self):
+        """Expire the items beyond the planet's cache limits.
+
+        Items are kept newest first until one is too old or would take
+        the channel over the item or size limit, then it and every older
+        item are expired.  Items in the feed as it was last updated are
+        always kept, or they'd be back as new on the next update.
+        """
+        max_items = self._planet.cache_max_items
+        max_days = self._planet.cache_max_days
+        max_size = self._planet.cache_max_size * 1024
+        if not max_items and not max_days and not max_size:
+            return
+
+        if max_size:
+            sizes = self._cache.item_sizes()
+        oldest = time.time() - max_days * 86400
+
+        kept = size = full = 0
+        for item in self.items(hidden=1, sorted=1):
+            if max_size:
+                # Stores have ids as they're kept, see CachedInfo
+                size += sizes.get(item._id, 0)
+            if self._feed_items.has_key(item.id):
+                kept += 1
+                continue
+
+            if not full:
+                full = (max_items and kept >= max_items) \
+                       or (max_days and item.date_epoch() < oldest) \
+                       or (max_size and size > max_size)
+            if full:
+                del(self._entries()[item.id])
+                self._expired.append(item)
+                count("entries_retired")
+                log.debug("Removed <%s> beyond the cache limits", item.id)
+            else:
+                kept += 1
 
     def feed_information(self):
         """
@@ -604,12 +1062,16 @@ class Channel(cache.CachedInfo):
         This does the actual work of pulling down the feed and if it changes
         updates the cached information about the feed and entries within it.
         """
-        info = feedparser.parse(self.url,
+        info = feedparser.iterparse(self.url,
                                 etag=self.url_etag, modified=self.url_modified,
-                                agent=self._planet.user_agent)
+                                agent=self._planet.user_agent,
+                                result_cache=self._planet.parse_cache,
+                                html_processor=self._planet.sanitize,
+                                html_processor_version=
+                                    self._planet.sanitize_version())
         if info.has_key("status"):
            self.url_status = str(info.status)
-        elif info.has_key("entries") and len(info.entries)>0:
+        elif info.has_key("entries") and info.entries:
            self.url_status = str(200)
         elif info.bozo and info.bozo_exception.__class__.__name__=='Timeout':
            self.url_status = str(408)
@@ -617,11 +1079,10 @@ class Channel(cache.CachedInfo):
            self.url_status = str(500)
 
         if self.url_status == '301' and \
-           (info.has_key("entries") and len(info.entries)>0):
+           (info.has_key("entries") and info.entries):
             log.warning("Feed has moved from <%s> to <%s>", self.url, info.url)
             try:
-                os.link(cache.filename(self._planet.cache_directory, self.url),
-                        cache.filename(self._planet.cache_directory, info.url))
+                self._cache.link(info.url)
             except:
                 pass
             self.url = info.url
@@ -650,8 +1111,18 @@ class Channel(cache.CachedInfo):
             log.debug("Last Modified: %s",
                       time.strftime(TIMEFMT_ISO, self.url_modified))
 
+        feed_keys = info.feed.keys()
         self.update_info(info.feed)
         self.update_entries(info.entries)
+
+        # Entries are parsed as they're updated, so feed information that
+        # comes after them is only seen now; the update time is ours though
+        late = feedparser.FeedParserDict()
+        for key in info.feed.keys():
+            if key not in feed_keys and not key.startswith("updated"):
+                late[key] = info.feed[key]
+        if late:
+            self.update_info(late)
         self.cache_write()
 
     def update_info(self, feed):
@@ -700,9 +1171,8 @@ class Channel(cache.CachedInfo):
                 try:
                     detail = key + '_detail'
                     if feed.has_key(detail) and feed[detail].has_key('type'):
-                        if feed[detail].type == 'text/html':
-                            feed[key] = sanitize.HTML(feed[key])
-                        elif feed[detail].type == 'text/plain':
+                        # feedparser sanitized HTML, see Planet.sanitize()
+                        if feed[detail].type == 'text/plain':
                             feed[key] = escape(feed[key])
                     self.set_as_string(key, feed[key])
                 except KeyboardInterrupt:
@@ -725,8 +1195,14 @@ class Channel(cache.CachedInfo):
         If the feed does not contain items which, according to the sort order,
         should be there; those items are assumed to have been expired from
         the feed or replaced and are removed from the cache.
+
+        Entries whose fingerprint matches the one stored with the cached
+        item haven't changed since the last update and are skipped.
+
+        The entries may be any iterable, each is done with before the next
+        is taken, so they can be parsed as they're needed.
         """
-        if not len(entries):
+        if not entries:
             return
 
         self.last_updated = self.updated
@@ -734,7 +1210,11 @@ class Channel(cache.CachedInfo):
 
         new_items = []
         feed_items = []
+        unchanged = 0
         for entry in entries:
+            # Fingerprint the entry before NewsItem.update modifies it
+            entry_fingerprint = fingerprint(entry)
+
             # Try really hard to find some kind of unique identifier
             if entry.has_key("id"):
                 entry_id = cache.utf8(entry.id)
@@ -757,7 +1237,12 @@ class Channel(cache.CachedInfo):
                 item = NewsItem(self, entry_id)
                 self._items[entry_id] = item
                 new_items.append(item)
-            item.update(entry)
+            if item.has_key("fingerprint") \
+                   and item.fingerprint == entry_fingerprint:
+                unchanged += 1
+            else:
+                item.update(entry)
+                item.fingerprint = entry_fingerprint
             feed_items.append(entry_id)
 
             # Hide excess items the first time through
@@ -769,15 +1254,22 @@ class Channel(cache.CachedInfo):
         # Assign order numbers in reverse
         new_items.reverse()
         for item in new_items:
-            item.order = self.next_order = str(int(self.next_order) + 1)
+            item.order = self.next_order = self.next_order + 1
+
+        self._feed_items = {}
+        for entry_id in feed_items:
+            self._feed_items[entry_id] = 1
 
         # Check for expired or replaced items
         feed_count = len(feed_items)
         log.debug("Items in Feed: %d", feed_count)
+        log.debug("Unchanged Items: %d", unchanged)
+        count("entries_updated", feed_count - unchanged)
+        count("entries_unchanged", unchanged)
         for item in self.items(sorted=1):
             if feed_count < 1:
                 break
-            elif item.id in feed_items:
+            elif self._feed_items.has_key(item.id):
                 feed_count -= 1
             elif item._channel.url_status != '226':
                 del(self._items[item.id])
@@ -796,7 +1288,8 @@ class NewsItem(cache.CachedInfo):
     """An item of news.
 
     This class represents a single item of news on a channel.  They're
-    created by members of the Channel class and accessible through it.
+    created by members of the Channel class and accessible through it,
+    or read from a store of their own, such as a render index.
 
     Properties:
         id              Channel-unique identifier for this item.
@@ -804,11 +1297,15 @@ class NewsItem(cache.CachedInfo):
         date            Corrected UTC-Normalised update time, for sorting.
         order           Order in which items on the same date can be sorted.
         hidden          Item should be hidden (True if exists).
+        fingerprint     Hash of the feed entry the item was last updated from.
 
         title           One-line title (*).
+        title_plain     Title with the HTML removed (*).
         link            Link to the original format text (*).
         summary         Short first-page summary (*).
         content         Full HTML content.
+        excerpt         First EXCERPT_WORDS words of the content as plain text.
+        word_count      Number of words in the content.
 
         modified        Date the item claims to have been modified (*).
         issued          Date the item claims to have been issued (*).
@@ -830,11 +1327,18 @@ class NewsItem(cache.CachedInfo):
 
     Some feeds may define additional properties to those above.
     """
+    __slots__ = ("_channel",)
+
     IGNORE_KEYS = ("categories", "contributors", "enclosures", "links",
                    "guidislink", "date", "tags")
 
-    def __init__(self, channel, id_):
-        cache.CachedInfo.__init__(self, channel._cache, id_)
+    # Keys read when the channel is, enough to sort, filter out hidden
+    # items and see whether an entry has changed without the rest
+    INDEX_KEYS = ("id", "date", "order", "hidden", "fingerprint", "updated",
+                  "modified", "published", "issued", "created")
+
+    def __init__(self, channel, id_, index=None, store=None):
+        cache.CachedInfo.__init__(self, store or channel._cache, id_)
 
         self._channel = channel
         self.id = id_
@@ -842,7 +1346,13 @@ class NewsItem(cache.CachedInfo):
         self.date = None
         self.order = None
         self.content = None
-        self.cache_read()
+        if index is None:
+            self.cache_read()
+        else:
+            self.cache_read_lazily(self.INDEX_KEYS, index)
+        if self.key_type("order") == self.STRING:
+            # Stored as a string by older versions
+            self.order = int(self.order)
 
     def update(self, entry):
         """Update the item from the feedparser entry given."""
@@ -880,9 +1390,7 @@ class NewsItem(cache.CachedInfo):
                 # Content field: concatenate the values
                 value = ""
                 for item in entry[key]:
-                    if item.type == 'text/html':
-                        item.value = sanitize.HTML(item.value)
-                    elif item.type == 'text/plain':
+                    if item.type == 'text/plain':
                         item.value = escape(item.value)
                     if item.has_key('language') and item.language and \
                        (not self._channel.has_key('language') or
@@ -896,9 +1404,7 @@ class NewsItem(cache.CachedInfo):
                     detail = key + '_detail'
                     if entry.has_key(detail):
                         if entry[detail].has_key('type'):
-                            if entry[detail].type == 'text/html':
-                                entry[key] = sanitize.HTML(entry[key])
-                            elif entry[detail].type == 'text/plain':
+                            if entry[detail].type == 'text/plain':
                                 entry[key] = escape(entry[key])
                     self.set_as_string(key, entry[key])
                 except KeyboardInterrupt:
@@ -907,11 +1413,27 @@ class NewsItem(cache.CachedInfo):
                     log.exception("Ignored '%s' of <%s>, unknown format",
                                   key, self.id)
 
+        # Plain text for the templates, so they needn't parse any HTML
+        if self.has_key("title") and self.key_type("title") != self.NULL:
+            self.set_as_string("title_plain",
+                               plain_text(self.get_as_string("title")))
+        words = plain_text(self.get_content("content"), stripBlocks).split()
+        self.set_as_int("word_count", len(words))
+        if len(words) > EXCERPT_WORDS:
+            self.set_as_string("excerpt",
+                               " ".join(words[:EXCERPT_WORDS]) + " ...")
+        else:
+            self.set_as_string("excerpt", " ".join(words))
+
         # Generate the date field if we need to
         self.get_date("date")
 
     def get_date(self, key):
-        """Get (or update) the date key.
+        """Get (or update) the date key, see date_epoch()."""
+        return tuple(time.gmtime(self.date_epoch(key)))
+
+    def date_epoch(self, key="date"):
+        """Get (or update) the date key as seconds since the epoch.
 
         We check whether the date the entry claims to have been changed is
         since we last updated this feed and when we pulled the feed off the
@@ -926,20 +1448,21 @@ class NewsItem(cache.CachedInfo):
 
         for other_key in ("updated", "modified", "published", "issued", "created"):
             if self.has_key(other_key):
-                date = self.get_as_date(other_key)
+                date = self.get_as_epoch(other_key)
                 break
         else:
             date = None
 
         if date is not None:
-            if date > self._channel.updated:
-                date = self._channel.updated
-#            elif date < self._channel.last_updated:
-#                date = self._channel.updated
+            updated = self._channel.get_as_epoch("updated")
+            if date > updated:
+                date = updated
+#            elif date < self._channel.get_as_epoch("last_updated"):
+#                date = updated
         elif self.has_key(key) and self.key_type(key) != self.NULL:
-            return self.get_as_date(key)
+            return self.get_as_epoch(key)
         else:
-            date = self._channel.updated
+            date = self._channel.get_as_epoch("updated")
 
         self.set_as_date(key, date)
         return date
@@ -12,6 +12,31 @@ that the rest of the code can take the persistance for granted.
 
 import os
 import re
+import time
+import md5
+import sha
+import gzip
+import zlib
+import mmap
+import shutil
+import struct
+import calendar
+import cStringIO
+
+try:
+    import dbhash
+except:
+    dbhash = None
+
+try:
+    import sqlite3
+except:
+    sqlite3 = None
+
+try:
+    import fcntl
+except:
+    fcntl = None
 
 
 # Regular expressions to sanitise cache filenames
@@ -20,117 +45,264 @@ re_slash         = re.compile(r'[?/]+')
 re_initial_cruft = re.compile(r'^[,.]*')
 re_final_cruft   = re.compile(r'[,.]*$')
 
+# Version of the binary encoding of dates and integers in dbhash caches,
+# stored with the type of each such value; dates stored as text by older
+# versions, without one, are still read
+VALUE_FORMAT = "2"
+
+# struct formats of the binary integers, by their size in bytes
+INT_FORMATS = {1: "!b", 2: "!h", 4: "!l", 8: "!q"}
+
+# Strings of at least this many bytes are stored compressed with zlib, if
+# that makes them smaller, with COMPRESSED_FORMAT in their type tag
+COMPRESS_MIN_SIZE = 1024
+COMPRESSED_FORMAT = "zlib"
+
+# First line of a cache snapshot, with the version of its format
+SNAPSHOT_HEADER = "Planet cache snapshot %s\n"
+SNAPSHOT_FORMAT = "1"
+
+# Most dbhash cache files to keep open at once, those used least recently
+# are closed to make room and opened again when they're next used
+MAX_OPEN_FILES = 64
+
+# Suffix added to the name of a dbhash cache file for the file locking it
+LOCK_SUFFIX = ".lock"
+
+# Item keys whose values are kept once in the body store shared by the
+# channels, and referred to by the items, once they're at least the size
+# in bytes given; smaller values are kept with the items
+BODY_KEYS = ("content", "summary")
+BODY_MIN_SIZE = 256
+
+# Type tag of a reference into the body store, and the name of the file
+# within the cache directory that's the store of dbhash caches
+BODY_TAG = "body"
+BODY_FILE = ".bodies"
+
+# First line of the journal of changes being made to a dbhash cache, with
+# the version of its format, and the suffix added to the file's name for it
+JOURNAL_HEADER = "Planet cache journal %s\n"
+JOURNAL_FORMAT = "1"
+JOURNAL_SUFFIX = ".journal"
+
+# First line of a render index, with the version of its format and the key
+# of what it was written for
+RENDER_INDEX_HEADER = "Planet render index %s %s\n"
+RENDER_INDEX_FORMAT = "1"
+
+# struct formats of a render index's counts, and of each item in its table:
+# the date and order it's sorted by, and its channel and records
+RENDER_INDEX_COUNTS = "!LL"
+RENDER_INDEX_ITEM = "!dlLLL"
+
+# Number and size of the records CachedInfo.cache_write() has written, and
+# of those it didn't need to because they hadn't changed
+WRITE_STATS = {"written": 0, "written_bytes": 0,
+               "unchanged": 0, "unchanged_bytes": 0}
 
-class CachedInfo:
+
+class CompressedString(object):
+    """A string value read from the cache compressed, see encode_value().
+
+    The value is kept compressed until it's wanted, which for most is
+    never: only the items that are rendered have their content used.
+    str() returns the string, CachedInfo.get_as_string() does so.
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return zlib.decompress(self.data)
+
+
+class CachedInfo(object):
     """Cached information.
 
     This class is designed to hold information that is stored in a cache
     between instances.  It can act both as a dictionary (c['foo']) and
-    as an object (c.foo) to get and set values and supports both string
-    and date values.
+    as an object (c.foo) to get and set values and supports string, date
+    and integer values.
 
     If you wish to support special fields you can derive a class off this
     and implement get_FIELD and set_FIELD functions which will be
     automatically called.
+
+    The cache given is a store, such as DBHashStore or a channel of a
+    SQLiteStore, holding the keys of the root (channel) information and
+    of each item under its id.
+
+    Keys that are set to a different value, or deleted, are remembered as
+    dirty until the next cache_write() so that only those are written.
+
+    Information can also be read lazily, see cache_read_lazily(), in which
+    case only some keys are read at first and the rest when needed.
+
+    To keep the many items of a large cache small, instances have slots
+    rather than a dictionary, and the values are kept in a single
+    dictionary with their type told by that of the value: str for
+    strings (or CompressedString, for large ones as read from the cache),
+    float for dates (seconds since the epoch), int for integers and None
+    for null.  Derived classes with attributes of their own
+    must name them in __slots__.
     """
+    __slots__ = ("_value", "_uncached", "_dirty", "_stored", "_lazy",
+                 "_cache", "_id", "_root")
+
     STRING = "string"
     DATE   = "date"
+    INT    = "int"
     NULL   = "null"
 
+    # Type of each key, by the type of its value
+    TYPES = { str: STRING, CompressedString: STRING, float: DATE, int: INT,
+              long: INT, type(None): NULL }
+
     def __init__(self, cache, id_, root=0):
-        self._type = {}
         self._value = {}
-        self._cached = {}
+        self._uncached = None
+        self._dirty = {}
+        self._stored = {}
+        self._lazy = None
 
         self._cache = cache
         self._id = id_.replace(" ", "%20")
         self._root = root
 
-    def cache_key(self, key):
-        """Return the cache key name for the given key."""
-        key = key.replace(" ", "_")
-        if self._root:
-            return key
-        else:
-            return self._id + " " + key
-
     def cache_read(self):
         """Read information from the cache."""
-        if self._root:
-            keys_key = " keys"
-        else:
-            keys_key = self._id
+        for key, type, value in self._cache.read(self._id, self._root):
+            self._read_record(key, value)
+
+    def cache_read_lazily(self, keys, records):
+        """Read only the given keys, from records already read from the cache.
+
+        The rest are read from the cache when any other key is first used.
+        Keys set before this are taken to be defaults: they're kept if the
+        cache hasn't got them, but not written to it unless they're changed.
+        """
+        for key, type, value in records:
+            self._read_record(key, value)
+
+        try:
+            self._lazy = _lazy_keys[keys]
+        except KeyError:
+            self._lazy = _lazy_keys[keys] = _lookup(keys)
+        self._dirty = {}
+
+    def _load(self):
+        """Read the keys that cache_read_lazily() left in the cache."""
+        lazy = self._lazy
+        self._lazy = None
+        for key, type, value in self._cache.read(self._id, self._root):
+            if not lazy.has_key(key):
+                self._read_record(key, value)
 
-        if self._cache.has_key(keys_key):
-            keys = self._cache[keys_key].split(" ")
+    def _read_record(self, key, value):
+        """Take a key read from the cache."""
+        self._stored[key] = 1
+        if self._uncached is None or not self._uncached.has_key(key):
+            # Key either hasn't been loaded, or is one for the cache
+            self._value[key] = value
+            if self._dirty.has_key(key):
+                del(self._dirty[key])
         else:
-            return
+            # Key isn't for the cache any more
+            self._dirty[key] = 1
 
-        for key in keys:
-            cache_key = self.cache_key(key)
-            if not self._cached.has_key(key) or self._cached[key]:
-                # Key either hasn't been loaded, or is one for the cache
-                self._value[key] = self._cache[cache_key]
-                self._type[key] = self._cache[cache_key + " type"]
-                self._cached[key] = 1
+    def _cached_keys(self):
+        """Return the list of keys for the cache."""
+        if self._uncached is None:
+            return self._value.keys()
+        return [ key for key in self._value.keys()
+                 if not self._uncached.has_key(key) ]
 
-    def cache_write(self, sync=1):
-        """Write information to the cache."""
-        self.cache_clear(sync=0)
+    def _record(self, key):
+        """Return the (key, type, value) record of the key."""
+        value = self._value[key]
+        return (key, self.TYPES[type(value)], value)
 
-        keys = []
-        for key in self.keys():
-            cache_key = self.cache_key(key)
-            if not self._cached[key]:
-                if self._cache.has_key(cache_key):
-                    # Non-cached keys need to be cleared
-                    del(self._cache[cache_key])
-                    del(self._cache[cache_key + " type"])
-                continue
+    def cache_write(self, sync=1):
+        """Write information to the cache.
 
-            keys.append(key)
-            self._cache[cache_key] = self._value[key]
-            self._cache[cache_key + " type"] = self._type[key]
+        Only the dirty keys are written, so nothing is if none have changed
+        since the information was read or last written.  Returns whether
+        anything was written.
+        """
+        if not self._dirty:
+            self._count_unchanged()
+            return 0
+        if self._lazy is not None:
+            self._load()
 
-        if self._root:
-            keys_key = " keys"
+        cached = self._cached_keys()
+        if not self._stored:
+            # Nothing in the cache yet, so write the lot
+            records = [ self._record(key) for key in cached ]
+            self._cache.write(self._id, self._root, records)
         else:
-            keys_key = self._id
+            records = []
+            removed = []
+            keys = None
+            for key in self._dirty.keys():
+                if self._value.has_key(key) and (self._uncached is None or
+                                                 not self._uncached.has_key(key)):
+                    records.append(self._record(key))
+                    if not self._stored.has_key(key):
+                        keys = 1
+                elif self._stored.has_key(key):
+                    removed.append(key)
+                    keys = 1
+            self._count_unchanged()
+
+            if keys:
+                # The list of keys has changed too
+                keys = cached
+            self._cache.update(self._id, self._root, records, removed, keys)
+
+        WRITE_STATS["written"] += len(records)
+        for key, type, value in records:
+            WRITE_STATS["written_bytes"] += len(encode_value(type, value)[1])
+
+        self._stored = _lookup(cached)
+        self._dirty = {}
 
-        self._cache[keys_key] = " ".join(keys)
         if sync:
             self._cache.sync()
+        return 1
+
+    def _count_unchanged(self):
+        """Count the stored keys that cache_write() needn't write."""
+        for key in self._stored.keys():
+            if not self._dirty.has_key(key):
+                WRITE_STATS["unchanged"] += 1
+                WRITE_STATS["unchanged_bytes"] += len(encode_value(
+                    *self._record(key)[1:])[1])
 
     def cache_clear(self, sync=1):
         """Remove information from the cache."""
-        if self._root:
-            keys_key = " keys"
-        else:
-            keys_key = self._id
-
-        if self._cache.has_key(keys_key):
-            keys = self._cache[keys_key].split(" ")
-            del(self._cache[keys_key])
-        else:
-            return
-
-        for key in keys:
-            cache_key = self.cache_key(key)
-            del(self._cache[cache_key])
-            del(self._cache[cache_key + " type"])
-
+        self._cache.clear(self._id, self._root)
+        self._stored = {}
+        for key in self.keys():
+            self._dirty[key] = 1
         if sync:
             self._cache.sync()
 
     def has_key(self, key):
         """Check whether the key exists."""
         key = key.replace(" ", "_")
+        if self._lazy is not None and not self._lazy.has_key(key):
+            self._load()
         return self._value.has_key(key)
 
     def key_type(self, key):
         """Return the key type."""
         key = key.replace(" ", "_")
-        return self._type[key]
+        if self._lazy is not None and not self._lazy.has_key(key):
+            self._load()
+        return self.TYPES[type(self._value[key])]
 
     def set(self, key, value, cached=1):
         """Set the value of the given key.
@@ -141,15 +313,14 @@ class CachedInfo:
         """
         key = key.replace(" ", "_")
 
-        try:
-            func = getattr(self, "set_" + key)
-        except AttributeError:
-            pass
-        else:
-            return func(key, value)
+        func = _hooks(self.__class__)[1].get(key)
+        if func is not None:
+            return func(self, key, value)
 
         if value == None:
             return self.set_as_null(key, value)
+        elif isinstance(value, (int, long)):
+            return self.set_as_int(key, value)
         else:
             try:
                 return self.set_as_string(key, value)
@@ -163,22 +334,44 @@ class CachedInfo:
         correctly typed function is called if that exists.
         """
         key = key.replace(" ", "_")
+        if self._lazy is not None and not self._lazy.has_key(key):
+            self._load()
+        return self._get(key)
 
-        try:
-            func = getattr(self, "get_" + key)
-        except AttributeError:
-            pass
-        else:
-            return func(key)
+    def _get(self, key):
+        """Return the value of the loaded key, as get() does."""
+        getters, setters, typed = _hooks(self.__class__)
+        func = getters.get(key)
+        if func is not None:
+            return func(self, key)
 
-        try:
-            func = getattr(self, "get_as_" + self._type[key])
-        except AttributeError:
-            pass
-        else:
-            return func(key)
+        value = self._value[key]
+        func = typed.get(type(value))
+        if func is not None:
+            return func(self, key)
+        return value
 
-        return self._value[key]
+    def _set(self, key, value, cached):
+        """Set the key to the value, marking it dirty if it's changed."""
+        if self._lazy is not None and not self._lazy.has_key(key):
+            self._load()
+
+        old = self._value.get(key, self)
+        if isinstance(old, CompressedString):
+            old = str(old)
+        if self._uncached is not None and self._uncached.has_key(key):
+            if cached:
+                del(self._uncached[key])
+                self._dirty[key] = 1
+        elif not cached:
+            if self._uncached is None:
+                self._uncached = {}
+            self._uncached[key] = 1
+            if old is not self:
+                self._dirty[key] = 1
+        elif old is self or old != value or type(old) != type(value):
+            self._dirty[key] = 1
+        self._value[key] = value
 
     def set_as_string(self, key, value, cached=1):
         """Set the key to the string value.
@@ -187,32 +380,34 @@ class CachedInfo:
         it's assumed to have failed decoding (feedparser tries pretty hard)
         so has all non-ASCII characters stripped.
         """
-        value = utf8(value)
-
-        key = key.replace(" ", "_")
-        self._value[key] = value
-        self._type[key] = self.STRING
-        self._cached[key] = cached
+        self._set(key.replace(" ", "_"), utf8(value), cached)
 
     def get_as_string(self, key):
-        """Return the key as a string value."""
+        """Return the key as a string value.
+
+        A value kept compressed is decompressed each time, rather than
+        kept decompressed, since it's rarely wanted more than once a run.
+        """
         key = key.replace(" ", "_")
         if not self.has_key(key):
             raise KeyError, key
 
-        return self._value[key]
+        value = self._value[key]
+        if isinstance(value, CompressedString):
+            return str(value)
+        return value
 
     def set_as_date(self, key, value, cached=1):
         """Set the key to the date value.
 
-        The date should be a 9-item tuple as returned by time.gmtime().
+        The date should be a 9-item tuple as returned by time.gmtime(), or
+        seconds since the epoch which is how it's kept.
         """
-        value = " ".join([ str(s) for s in value ])
-
-        key = key.replace(" ", "_")
-        self._value[key] = value
-        self._type[key] = self.DATE
-        self._cached[key] = cached
+        if isinstance(value, (int, long, float)):
+            value = float(value)
+        else:
+            value = float(calendar.timegm(value))
+        self._set(key.replace(" ", "_"), value, cached)
 
     def get_as_date(self, key):
         """Return the key as a date value."""
@@ -220,18 +415,34 @@ class CachedInfo:
         if not self.has_key(key):
             raise KeyError, key
 
-        value = self._value[key]
-        return tuple([ int(i) for i in value.split(" ") ])
+        return tuple(time.gmtime(self._value[key]))
+
+    def get_as_epoch(self, key):
+        """Return the date key as seconds since the epoch."""
+        key = key.replace(" ", "_")
+        if not self.has_key(key):
+            raise KeyError, key
+
+        return self._value[key]
+
+    def set_as_int(self, key, value, cached=1):
+        """Set the key to the integer value."""
+        self._set(key.replace(" ", "_"), int(value), cached)
+
+    def get_as_int(self, key):
+        """Return the key as an integer value."""
+        key = key.replace(" ", "_")
+        if not self.has_key(key):
+            raise KeyError, key
+
+        return self._value[key]
 
     def set_as_null(self, key, value, cached=1):
         """Set the key to the null value.
 
         This only exists to make things less magic.
         """
-        key = key.replace(" ", "_")
-        self._value[key] = ""
-        self._type[key] = self.NULL
-        self._cached[key] = cached
+        self._set(key.replace(" ", "_"), None, cached)
 
     def get_as_null(self, key):
         """Return the key as the null value."""
@@ -247,17 +458,21 @@ class CachedInfo:
         if not self.has_key(key):
             raise KeyError, key
 
+        if self._uncached is not None and self._uncached.has_key(key):
+            del(self._uncached[key])
+        else:
+            self._dirty[key] = 1
         del(self._value[key])
-        del(self._type[key])
-        del(self._cached[key])
 
     def keys(self):
         """Return the list of cached keys."""
+        if self._lazy is not None:
+            self._load()
         return self._value.keys()
 
     def __iter__(self):
         """Iterate the cached keys."""
-        return iter(self._value.keys())
+        return iter(self.keys())
 
     # Special methods
     __contains__ = has_key
@@ -268,16 +483,1749 @@ class CachedInfo:
 
     def __setattr__(self, key, value):
         if key.startswith("_"):
-            self.__dict__[key] = value
+            object.__setattr__(self, key, value)
         else:
             self.set(key, value)
 
     def __getattr__(self, key):
-        if self.has_key(key):
-            return self.get(key)
+        # Attribute names have no spaces to replace
+        if key.startswith("_"):
+            raise AttributeError, key
+        if self._lazy is not None and not self._lazy.has_key(key):
+            self._load()
+        if self._value.has_key(key):
+            return self._get(key)
         else:
             raise AttributeError, key
 
+# Dictionaries of the keys given to cache_read_lazily(), shared by the items
+_lazy_keys = {}
+
+# get_KEY, set_KEY and typed get_as_TYPE functions of each class, see _hooks()
+_class_hooks = {}
+
+def _hooks(cls):
+    """Return the get_KEY and set_KEY functions of the CachedInfo class.
+
+    These are found once per class and returned as dictionaries of the
+    get_ and set_ functions by KEY, and of the get_as_TYPE functions by
+    the type of value they're for.  CachedInfo's own get_as_TYPE
+    functions that just return the value are left out, so that values
+    of those types needn't go through them; CompressedString values
+    always do, to be decompressed.
+    """
+    try:
+        return _class_hooks[cls]
+    except KeyError:
+        pass
+
+    getters = {}
+    setters = {}
+    for name in dir(cls):
+        if name.startswith("get_"):
+            getters[name[4:]] = getattr(cls, name)
+        elif name.startswith("set_"):
+            setters[name[4:]] = getattr(cls, name)
+
+    typed = {}
+    for value_type, type_name in cls.TYPES.items():
+        func = getters.get("as_" + type_name)
+        if func is None:
+            continue
+        if type_name != CachedInfo.DATE and \
+               value_type is not CompressedString and \
+               func.im_func is CachedInfo.__dict__["get_as_" + type_name]:
+            continue
+        typed[value_type] = func
+
+    _class_hooks[cls] = (getters, setters, typed)
+    return _class_hooks[cls]
+
+def _lookup(keys):
+    """Return a dictionary of the keys, for looking them up in."""
+    lookup = {}
+    for key in keys:
+        lookup[key] = 1
+    return lookup
+
+
+class DBHashStore:
+    """Cache store keeping a channel in a Berkeley DB hash file of its own.
+
+    Every field is kept under its own key, prefixed with the item id for
+    items, with its type under the same key followed by " type".  The
+    list of the channel's keys is kept under " keys" and that of each
+    item under the item id.
+
+    The items are indexed under " items", a line of each item's date and
+    id, newest first.  It's kept in memory and written when the store is
+    synced, and built from the keys for files written without one.
+
+    Changes are only made to the file when the store is synced and the
+    cache flushed, all together, see DBHashFile.
+
+    Item bodies, see BODY_KEYS, are kept in the BodyStore of the cache
+    directory with a reference to them under the key, typed BODY_TAG.
+    """
+    def __init__(self, filename, flag="c"):
+        self.filename = filename
+        self._db = DBHashFile(filename, flag)
+        self._bodies = body_store(os.path.dirname(filename))
+        self._flag = flag
+        self._items = None
+        self._items_changed = 0
+
+    def _keys_key(self, id_, root):
+        if root:
+            return " keys"
+        else:
+            return id_
+
+    def _cache_key(self, id_, root, key):
+        if root:
+            return key
+        else:
+            return id_ + " " + key
+
+    def read(self, id_, root, keys=None):
+        """Return the (key, type, value) records stored for id_.
+
+        If keys is given, a dictionary, only records of those are returned.
+        """
+        keys_key = self._keys_key(id_, root)
+        if not self._db.has_key(keys_key):
+            return []
+
+        records = []
+        for key in self._db[keys_key].split(" "):
+            if keys is not None and not keys.has_key(key):
+                continue
+            cache_key = self._cache_key(id_, root, key)
+            type, value = self._decode(self._db[cache_key + " type"],
+                                       self._db[cache_key])
+            records.append((key, type, value))
+        return records
+
+    def _encode(self, root, key, type, value):
+        """Return the type tag and string to store an id's record as."""
+        if not root and _is_body(key, type, value):
+            return BODY_TAG, self._bodies.put(value)
+        return encode_value(type, value)
+
+    def _decode(self, tag, value):
+        """Return the type and value of a record stored with the type tag."""
+        if tag == BODY_TAG:
+            return _read_body(self._bodies.get(value))
+        return decode_value(tag, value)
+
+    def write(self, id_, root, records):
+        """Replace the records stored for id_."""
+        self.clear(id_, root)
+
+        keys = []
+        for key, type, value in records:
+            cache_key = self._cache_key(id_, root, key)
+            type, value = self._encode(root, key, type, value)
+            self._db[cache_key] = value
+            self._db[cache_key + " type"] = type
+            keys.append(key)
+        self._db[self._keys_key(id_, root)] = " ".join(keys)
+
+        if not root:
+            self._index_item(id_, records)
+
+    def update(self, id_, root, records, removed, keys=None):
+        """Store changed records for id_ and remove the removed keys.
+
+        keys is the new list of all of id_'s keys, if that's changed.
+        """
+        for key, type, value in records:
+            cache_key = self._cache_key(id_, root, key)
+            type, value = self._encode(root, key, type, value)
+            self._db[cache_key] = value
+            self._db[cache_key + " type"] = type
+        for key in removed:
+            cache_key = self._cache_key(id_, root, key)
+            for cache_key in (cache_key, cache_key + " type"):
+                if self._db.has_key(cache_key):
+                    del(self._db[cache_key])
+        if keys is not None:
+            self._db[self._keys_key(id_, root)] = " ".join(keys)
+
+        if root:
+            return
+        if "date" in removed:
+            self._index_item(id_, [])
+        else:
+            for record in records:
+                if record[0] == "date":
+                    self._index_item(id_, [ record ])
+
+    def clear(self, id_, root):
+        """Remove the records stored for id_."""
+        keys_key = self._keys_key(id_, root)
+        if not self._db.has_key(keys_key):
+            return
+
+        for key in self._db[keys_key].split(" "):
+            cache_key = self._cache_key(id_, root, key)
+            for cache_key in (cache_key, cache_key + " type"):
+                if self._db.has_key(cache_key):
+                    del(self._db[cache_key])
+        del(self._db[keys_key])
+
+        if not root and self._index().has_key(id_):
+            del(self._items[id_])
+            self._items_changed = 1
+
+    def _index(self):
+        """Return the item index, a dictionary of each item's date."""
+        if self._items is not None:
+            return self._items
+
+        self._items = {}
+        if self._db.has_key(" items"):
+            for line in self._db[" items"].split("\n"):
+                if line:
+                    date, id_ = line.split(" ", 1)
+                    if date:
+                        self._items[id_] = int(date)
+                    else:
+                        self._items[id_] = None
+            return self._items
+
+        # Written before there was an index, find the items from the keys
+        root = {}
+        if self._db.has_key(" keys"):
+            for key in self._db[" keys"].split(" "):
+                root[key] = 1
+        for key in self._db.keys():
+            if key.find(" ") == -1 and not root.has_key(key):
+                self._index_item(key, self.read(key, 0, { "date": 1 }))
+        self._items_changed = 1
+        return self._items
+
+    def _index_item(self, id_, records):
+        """Put the item in the index with the date in its records."""
+        date = None
+        for key, type, value in records:
+            if key == "date" and type == CachedInfo.DATE:
+                date = value
+        self._index()[id_] = date
+        self._items_changed = 1
+
+    def item_ids(self, count=0):
+        """Return the ids of the items stored, newest first.
+
+        If count is given, at most that many are returned.
+        """
+        items = [ (date, id_) for id_, date in self._index().items() ]
+        items.sort()
+        items.reverse()
+        if count:
+            items = items[:count]
+        return [ id_ for date, id_ in items ]
+
+    def read_items(self, keys):
+        """Return (id, records) for every item, with only the given keys."""
+        wanted = {}
+        for key in keys:
+            wanted[key] = 1
+
+        return [ (id_, self.read(id_, 0, wanted)) for id_ in self.item_ids() ]
+
+    def counts(self):
+        """Return the numbers of items and of fields, the channel's too.
+
+        These are found from the keys in the file, not the item index or
+        key lists, to check copies of the channel against: each field
+        is kept under two keys, its value and its type, and each item
+        has one more, its list of keys.  Items are found as _index()
+        finds them in files without an index.
+        """
+        root = {}
+        if self._db.has_key(" keys"):
+            for key in self._db[" keys"].split(" "):
+                root[key] = 1
+
+        keys = items = 0
+        for key in self._db.keys():
+            if key.startswith(" "):
+                continue
+            keys += 1
+            if key.find(" ") == -1 and not root.has_key(key):
+                items += 1
+        return items, (keys - items) / 2
+
+    def item_sizes(self):
+        """Return a dictionary of the bytes each item takes in the file.
+
+        The bodies an item refers to are counted as the size they take in
+        the body store, whether or not other items refer to them too.
+        """
+        sizes = {}
+        for id_ in self._index().keys():
+            if not self._db.has_key(id_):
+                continue
+            keys = self._db[id_]
+            size = len(id_) + len(keys)
+            for key in keys.split(" "):
+                cache_key = self._cache_key(id_, 0, key)
+                if self._db.has_key(cache_key + " type") \
+                       and self._db[cache_key + " type"] == BODY_TAG:
+                    size += self._bodies.size(self._db[cache_key])
+                for cache_key in (cache_key, cache_key + " type"):
+                    if self._db.has_key(cache_key):
+                        size += len(cache_key) + len(self._db[cache_key])
+            sizes[id_] = size
+        return sizes
+
+    def link(self, url):
+        """Make the channel also available under a new URL."""
+        # The journal is only found under the old one
+        self.sync()
+        flush()
+        os.link(self.filename,
+                filename(os.path.dirname(self.filename), url))
+
+    def vacuum(self):
+        """Rewrite the file without the space of removed records.
+
+        Strings stored as they are by older versions are stored as they
+        would be now first: bodies moved into the body store and large
+        strings compressed.  See DBHashFile.vacuum().
+        """
+        for type_key in self._db.keys():
+            if not type_key.endswith(" type") \
+                   or self._db[type_key] != CachedInfo.STRING:
+                continue
+            cache_key = type_key[:-len(" type")]
+            key = cache_key[cache_key.rfind(" ") + 1:]
+            tag, value = self._encode(key == cache_key, key,
+                                      CachedInfo.STRING, self._db[cache_key])
+            if tag != CachedInfo.STRING:
+                self._db[type_key] = tag
+                self._db[cache_key] = value
+        self.sync()
+        self._db.vacuum()
+
+    def sync(self):
+        if self._items_changed:
+            lines = []
+            for id_ in self.item_ids():
+                if self._items[id_] is None:
+                    lines.append(" " + id_)
+                else:
+                    lines.append("%d %s" % (self._items[id_], id_))
+            self._db[" items"] = "\n".join(lines)
+            self._items_changed = 0
+        # Before the references to them
+        self._bodies.sync()
+        self._db.sync()
+
+    def close(self):
+        """Sync and close the file, until the store is next used."""
+        if self._flag != "r":
+            self.sync()
+        self._db.close()
+
+class DBHashFile:
+    """A dbhash file whose changes are made together.
+
+    Changes are kept in memory until sync(), which writes them to a
+    journal beside the file, and flush() makes the changes in every
+    journal written since it was last called, so the file is never left
+    half-way between two flushes: a journal found when the file is
+    opened is of changes that weren't made yet, or were being made when
+    the process or the system died, and they're made again.  A journal
+    is written under a temporary name and renamed into place, so one
+    that isn't complete is of changes that weren't begun, and is
+    removed.
+
+    Nothing is forced to disk until flush(), which does it for all the
+    journals at once before changing any of the files, and for all the
+    files at once before removing any of the journals.
+
+    At most MAX_OPEN_FILES files are open at once, the one used least
+    recently being closed when another needs opening.  Unsynced changes
+    are in memory, so that's never noticed: the file is simply opened
+    again when it's next used.  close() likewise only closes the file
+    until then.
+
+    While it's open, the file is locked against other processes, see
+    lock(): shared when it's opened read-only, otherwise exclusively.
+    """
+    def __init__(self, filename, flag="c"):
+        self.filename = filename
+        self._db = None
+        self._lock = None
+        self._flag = flag
+        self._changes = {}
+        self._file()
+        if flag == "n":
+            self._flag = "w"
+
+        journal = filename + JOURNAL_SUFFIX
+        if _pending.has_key(filename):
+            # Synced by this process and waiting for flush()
+            self._changes = _pending[filename]._changes
+        elif os.path.exists(journal):
+            changes = read_journal(journal)
+            if changes is not None:
+                self._changes = changes
+                if flag != "r":
+                    _pending[filename] = self
+            elif flag != "r":
+                os.remove(journal)
+        if flag != "r" and os.path.exists(journal + ".tmp"):
+            os.remove(journal + ".tmp")
+
+    def _file(self):
+        """Return the open dbhash file, opening it if it isn't."""
+        global _uses
+        _uses += 1
+        if self._db is None:
+            if len(_open_files) >= MAX_OPEN_FILES:
+                oldest = min([ (used, file)
+                               for file, used in _open_files.items() ])
+                oldest[1].close()
+            if dbhash is None:
+                raise ImportError, "The dbhash cache needs the bsddb module"
+            db = dbhash.open(self.filename, self._flag, 0666)
+            try:
+                self._lock = lock(self.filename + LOCK_SUFFIX,
+                                  self._flag != "r")
+            except:
+                db.close()
+                raise
+            self._db = db
+        _open_files[self] = _uses
+        return self._db
+
+    def has_key(self, key):
+        if self._changes.has_key(key):
+            return self._changes[key] is not None
+        return self._file().has_key(key)
+
+    def __getitem__(self, key):
+        if self._changes.has_key(key):
+            if self._changes[key] is None:
+                raise KeyError, key
+            return self._changes[key]
+        return self._file()[key]
+
+    def __setitem__(self, key, value):
+        self._changes[key] = value
+
+    def __delitem__(self, key):
+        if not self.has_key(key):
+            raise KeyError, key
+        self._changes[key] = None
+
+    def keys(self):
+        keys = {}
+        for key in self._file().keys():
+            keys[key] = 1
+        for key, value in self._changes.items():
+            if value is None:
+                if keys.has_key(key):
+                    del(keys[key])
+            else:
+                keys[key] = 1
+        return keys.keys()
+
+    def sync(self):
+        """Write the changes to the journal, for flush() to make them."""
+        if not self._changes:
+            if self._db is not None:
+                self._db.sync()
+            return
+
+        journal = self.filename + JOURNAL_SUFFIX
+        fd = open(journal + ".tmp", "wb")
+        try:
+            data = [ JOURNAL_HEADER % JOURNAL_FORMAT ]
+            for key, value in self._changes.items():
+                if value is None:
+                    data.append(_encode_entry("D", key))
+                else:
+                    data.append(_encode_entry("S", key, value))
+            data = "".join(data)
+            fd.write(data)
+            fd.write(_encode_entry("E", md5.new(data).hexdigest()))
+        finally:
+            fd.close()
+        os.rename(journal + ".tmp", journal)
+        _pending[self.filename] = self
+
+    def _apply(self):
+        """Make the changes in the journal to the file.
+
+        The journal is left for flush() to remove once the file is on
+        the disk.
+        """
+        db = self._file()
+        for key, value in self._changes.items():
+            if value is not None:
+                db[key] = value
+            elif db.has_key(key):
+                del(db[key])
+        db.sync()
+        # Shared with any other DBHashFile of the file, see __init__()
+        self._changes.clear()
+
+    def vacuum(self):
+        """Rewrite the file without the space of removed records.
+
+        Berkeley DB reuses the space of removed records but never gives
+        it back, so the records are copied into a new file that replaces
+        the old one.  A file linked under other URLs is copied over in
+        place so every name sees the new one.
+        """
+        self.sync()
+        flush()
+        new_filename = self.filename + ".vacuum"
+        new = dbhash.open(new_filename, "n", 0666)
+        for key in self.keys():
+            new[key] = self[key]
+        new.close()
+        self.close()
+
+        if os.stat(self.filename).st_nlink > 1:
+            shutil.copyfile(new_filename, self.filename)
+            os.remove(new_filename)
+        else:
+            os.rename(new_filename, self.filename)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            del(_open_files[self])
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+# Open DBHashFiles, with the count of uses of any when each was last used
+_open_files = {}
+_uses = 0
+
+def lock(filename, exclusive=1, wait=1):
+    """Take an advisory lock on filename, held until the file returned is closed.
+
+    Exclusive locks are held by one process at a time, shared locks by
+    any number while no process holds an exclusive one.  If wait is
+    false and the lock can't be had at once IOError is raised, otherwise
+    this waits for it.  Where there's no fcntl, or the lock file can't
+    be written, there's no locking and None is returned.
+    """
+    try:
+        fd = open(filename, "a")
+    except IOError:
+        return None
+    if fcntl is None:
+        fd.close()
+        return None
+
+    if exclusive:
+        operation = fcntl.LOCK_EX
+    else:
+        operation = fcntl.LOCK_SH
+    if not wait:
+        operation = operation | fcntl.LOCK_NB
+    try:
+        fcntl.flock(fd.fileno(), operation)
+    except:
+        fd.close()
+        raise
+    return fd
+
+def read_journal(filename):
+    """Return the changes in a dbhash cache's journal.
+
+    Returns None if the journal isn't complete.
+    """
+    data = open(filename, "rb").read()
+    # The journal ends with an entry of the MD5 digest of the rest
+    end = len(data) - 37
+    changes = {}
+    try:
+        if end < 0 or data[end] != "E" \
+               or data[:end].find(JOURNAL_HEADER % JOURNAL_FORMAT) != 0:
+            raise ValueError
+        fd = cStringIO.StringIO(data[end + 1:])
+        if _read_fields(fd, 1)[0] != md5.new(data[:end]).hexdigest():
+            raise ValueError
+
+        fd = cStringIO.StringIO(data[:end])
+        fd.readline()
+        while 1:
+            kind = fd.read(1)
+            if kind == "S":
+                key, value = _read_fields(fd, 2)
+                changes[key] = value
+            elif kind == "D":
+                key, = _read_fields(fd, 1)
+                changes[key] = None
+            elif kind == "":
+                return changes
+            else:
+                raise ValueError
+    except ValueError:
+        return None
+
+def flush():
+    """Make the changes in the dbhash cache journals written since the last time.
+
+    Each journal is forced to disk, then the changes in it are made to
+    its file, then the files are forced to disk and the journals
+    removed.  Doing it once when a run is done writing to the cache
+    does it once for all the files written, rather than for each.
+    """
+    files = [ file for file in _pending.values()
+              if os.path.exists(file.filename + JOURNAL_SUFFIX) ]
+    _pending.clear()
+    directories = {}
+    for file in files:
+        _fsync(file.filename + JOURNAL_SUFFIX)
+        directories[os.path.dirname(file.filename) or os.curdir] = 1
+    # For the journals renamed into place
+    _fsync_directories(directories)
+
+    for file in files:
+        opened = file._db is not None
+        file._apply()
+        if not opened:
+            # Closed since it was synced, so not to be left locked
+            file.close()
+        if os.path.exists(file.filename):
+            _fsync(file.filename)
+    for file in files:
+        os.remove(file.filename + JOURNAL_SUFFIX)
+    # A journal that comes back is only made again
+    _fsync_directories(directories)
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _fsync_directories(directories):
+    for directory in directories.keys():
+        try:
+            _fsync(directory)
+        except OSError:
+            pass
+
+# DBHashFiles with journals waiting for flush(), by the name of the file
+_pending = {}
+
+class BodyStore:
+    """Item bodies shared by the dbhash caches of a directory.
+
+    Feeds that are syndicated or cross-posted have the same bodies as
+    each other, so rather than keep a copy with every item each body is
+    kept once in a file of its own, compressed, under the SHA-1 digest
+    of it.  Items keep the digest, see DBHashStore.
+
+    Bodies are never removed as items are, since others may refer to
+    them; sweep() removes those that none do.  The file is only opened
+    for writing when a body is first put in it, so that runs that only
+    read bodies share it.  Use body_store() to get the store of a
+    directory.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = None
+        self._writing = 0
+
+    def _file(self, writing=0):
+        """Return the DBHashFile, opening it for writing if need be."""
+        if self._db is None or writing and not self._writing:
+            if self._db is not None:
+                self._db.close()
+            if writing:
+                self._db = DBHashFile(self.filename, "c")
+            else:
+                self._db = DBHashFile(self.filename, "r")
+            self._writing = writing
+        return self._db
+
+    def put(self, body):
+        """Store the body, if it isn't already, and return its digest."""
+        digest = _body_digest(body)
+        db = self._file(1)
+        if not db.has_key(digest):
+            db[digest] = _compress(body)
+        return digest
+
+    def get(self, digest):
+        """Return the compressed body with the digest, or None."""
+        try:
+            return self._file()[digest]
+        except KeyError:
+            return None
+
+    def size(self, digest):
+        """Return the bytes the body with the digest takes."""
+        body = self.get(digest)
+        if body is None:
+            return 0
+        return len(digest) + len(body)
+
+    def sweep(self, digests):
+        """Remove the bodies whose digests aren't in the dictionary given.
+
+        Returns the number removed.
+        """
+        db = self._file(1)
+        removed = 0
+        for digest in db.keys():
+            if not digests.has_key(digest):
+                del(db[digest])
+                removed += 1
+        db.sync()
+        return removed
+
+    def vacuum(self):
+        """Rewrite the file without the space of removed bodies."""
+        self._file(1).vacuum()
+
+    def sync(self):
+        if self._db is not None:
+            self._db.sync()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+def body_store(directory):
+    """Return the BodyStore of the dbhash caches in directory.
+
+    There's one for each directory, however many stores use it.
+    """
+    directory = os.path.normpath(directory)
+    if not _body_stores.has_key(directory):
+        _body_stores[directory] = BodyStore(os.path.join(directory,
+                                                         BODY_FILE))
+    return _body_stores[directory]
+
+def sweep_bodies(directory):
+    """Remove the bodies no dbhash cache in directory refers to any more.
+
+    Every file in directory is looked through for references, so none
+    may be written to meanwhile, nor bodies put into the store that
+    aren't referred to yet; the run lock is needed for that.  Returns the
+    number of bodies removed.
+    """
+    digests = {}
+    for name in os.listdir(directory):
+        if name == BODY_FILE or name.endswith(LOCK_SUFFIX) \
+               or name.endswith(JOURNAL_SUFFIX):
+            continue
+        try:
+            db = DBHashFile(os.path.join(directory, name), "r")
+        except:
+            continue
+
+        try:
+            for key in db.keys():
+                if key.endswith(" type") and db[key] == BODY_TAG:
+                    digests[db[key[:-len(" type")]]] = 1
+        finally:
+            db.close()
+
+    return body_store(directory).sweep(digests)
+
+def _is_body(key, type, value):
+    """Return whether an item's record belongs in the body store."""
+    if type != CachedInfo.STRING or key not in BODY_KEYS:
+        return 0
+    # Compressed values are at least that size
+    return isinstance(value, CompressedString) or len(value) >= BODY_MIN_SIZE
+
+def _body_digest(body):
+    return sha.new(str(body)).hexdigest()
+
+def _compress(body):
+    """Return the body compressed, as it's kept in a body store."""
+    if isinstance(body, CompressedString):
+        return body.data
+    return zlib.compress(body)
+
+def _read_body(body):
+    """Return the type and value of a compressed body from a body store.
+
+    The body is left compressed, see CompressedString.  A body missing
+    from the store is read as null, rather than fail reading the item
+    it's in.
+    """
+    if body is None:
+        return CachedInfo.NULL, None
+    return CachedInfo.STRING, CompressedString(str(body))
+
+# BodyStores, by the directory they're for
+_body_stores = {}
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS channel (
+    id      INTEGER PRIMARY KEY,
+    url     TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS alias (
+    url     TEXT PRIMARY KEY,
+    channel INTEGER NOT NULL REFERENCES channel (id)
+);
+CREATE TABLE IF NOT EXISTS item (
+    channel INTEGER NOT NULL REFERENCES channel (id),
+    id      TEXT NOT NULL,
+    date    REAL,
+    hidden  INTEGER NOT NULL DEFAULT 0,
+    ord     INTEGER,
+    PRIMARY KEY (channel, id)
+);
+CREATE INDEX IF NOT EXISTS item_date ON item (date);
+CREATE INDEX IF NOT EXISTS item_hidden ON item (hidden, date);
+CREATE INDEX IF NOT EXISTS item_order ON item (channel, ord);
+CREATE INDEX IF NOT EXISTS item_channel_date ON item (channel, date, id);
+CREATE TABLE IF NOT EXISTS field (
+    channel INTEGER NOT NULL REFERENCES channel (id),
+    item    TEXT NOT NULL,
+    key     TEXT NOT NULL,
+    type    TEXT NOT NULL,
+    value   NOT NULL,
+    PRIMARY KEY (channel, item, key)
+);
+CREATE TABLE IF NOT EXISTS body (
+    hash    TEXT PRIMARY KEY,
+    value   BLOB NOT NULL
+);
+"""
+
+class SQLiteStore:
+    """Cache of every channel in a single SQLite database.
+
+    The channel table gives each channel URL a number, and the alias
+    table any further URLs a channel has moved to the same number, as
+    further names for a dbhash file are links to it.  The field table
+    holds every field of every channel and item, with the channel's own
+    fields under an empty item id, dates and integers as SQLite integers
+    and large strings compressed.  The item table has a row for each
+    item with its date, hidden flag and order, indexed so the items to
+    show can be found without reading their fields.  The body table keeps
+    item bodies as a BodyStore does, the fields of the items having them
+    typed BODY_TAG with the SHA-1 digest of the body as their value.
+
+    The database is kept in write-ahead log mode, each sync() commits
+    the changes made since the last atomically but doesn't wait for them
+    to get to the disk, flush() does that for all of them at once.
+
+    Use channel() to get the store for a particular channel.
+    """
+    def __init__(self, filename):
+        if sqlite3 is None:
+            raise ImportError, "the SQLite cache needs the sqlite3 module"
+
+        self.filename = filename
+        self._db = sqlite3.connect(filename)
+        self._db.text_factory = str
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.executescript(SQLITE_SCHEMA)
+
+    def channel(self, url):
+        """Return the store for the channel with the given URL."""
+        row = self._db.execute("SELECT id FROM channel WHERE url = ? "
+                               "UNION ALL SELECT channel FROM alias WHERE url = ?",
+                               (url, url)).fetchone()
+        if row is None:
+            return SQLiteChannelStore(self._db, self._db.execute(
+                "INSERT INTO channel (url) VALUES (?)", (url,)).lastrowid)
+        else:
+            return SQLiteChannelStore(self._db, row[0])
+
+    def urls(self):
+        """Return the URLs of the channels stored, not their aliases."""
+        return [ row[0] for row in self._db.execute("SELECT url FROM channel") ]
+
+    def sync(self):
+        self._db.commit()
+
+    def rollback(self):
+        """Undo the changes made since the last sync()."""
+        self._db.rollback()
+
+    def flush(self):
+        """Commit and force everything committed to disk."""
+        self._db.commit()
+        self._db.execute("PRAGMA wal_checkpoint(FULL)")
+
+    def vacuum(self):
+        """Rebuild the database file without the space of removed rows.
+
+        Strings stored as they are by older versions are stored as they
+        would be now first, bodies moved into the body table and large
+        strings compressed, and bodies no item refers to any more are
+        removed.
+        """
+        for channel, item, key, value in self._db.execute(
+            "SELECT channel, item, key, value FROM field "
+            "WHERE type = ? AND LENGTH(CAST(value AS BLOB)) >= ?",
+            (CachedInfo.STRING,
+             min(BODY_MIN_SIZE, COMPRESS_MIN_SIZE))).fetchall():
+            SQLiteChannelStore(self._db, channel).update(
+                item, not item, [ (key, CachedInfo.STRING, value) ], [])
+        self._db.execute("DELETE FROM body WHERE hash NOT IN "
+                         "(SELECT value FROM field WHERE type = ?)",
+                         (BODY_TAG,))
+        self._db.commit()
+        self._db.execute("VACUUM")
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+class SQLiteChannelStore:
+    """Store for one channel in a SQLiteStore."""
+    def __init__(self, db, channel):
+        self._db = db
+        self._channel = channel
+
+    def read(self, id_, root):
+        """Return the (key, type, value) records stored for id_."""
+        if root:
+            id_ = ""
+
+        return [ (key,) + _decode_field(type, value, body)
+                 for key, type, value, body in self._db.execute(
+            "SELECT key, type, field.value, body.value FROM field "
+            "LEFT JOIN body ON type = ? AND hash = field.value "
+            "WHERE channel = ? AND item = ?",
+            (BODY_TAG, self._channel, id_)) ]
+
+    def write(self, id_, root, records):
+        """Replace the records stored for id_."""
+        self.clear(id_, root)
+        if root:
+            id_ = ""
+
+        self._db.executemany(
+            "INSERT INTO field (channel, item, key, type, value) "
+            "VALUES (?, ?, ?, ?, ?)",
+            self._rows(id_, records))
+        if not root:
+            self._write_item(id_, records)
+
+    def _rows(self, id_, records):
+        """Return the field rows of id_'s records, null stored as "".
+
+        Large strings are stored compressed, as blobs, as encode_value()
+        stores them.  The bodies among an item's records are stored in
+        the body table, if they aren't already, and their rows refer to
+        them.
+        """
+        rows = []
+        for key, type, value in records:
+            if value is None:
+                value = ""
+            elif id_ and _is_body(key, type, value):
+                type = BODY_TAG
+                value = self._put_body(value)
+            elif type == CachedInfo.STRING:
+                type, value = encode_value(type, value)
+                if type != CachedInfo.STRING:
+                    value = buffer(value)
+            rows.append((self._channel, id_, key, type, value))
+        return rows
+
+    def _put_body(self, body):
+        """Store the body, if it isn't already, and return its digest."""
+        digest = _body_digest(body)
+        if self._db.execute("SELECT 1 FROM body WHERE hash = ?",
+                            (digest,)).fetchone() is None:
+            self._db.execute("INSERT INTO body (hash, value) VALUES (?, ?)",
+                             (digest, buffer(_compress(body))))
+        return digest
+
+    def update(self, id_, root, records, removed, keys=None):
+        """Store changed records for id_ and remove the removed keys."""
+        if root:
+            id_ = ""
+
+        self._db.executemany(
+            "INSERT OR REPLACE INTO field (channel, item, key, type, value) "
+            "VALUES (?, ?, ?, ?, ?)",
+            self._rows(id_, records))
+        self._db.executemany(
+            "DELETE FROM field WHERE channel = ? AND item = ? AND key = ?",
+            [ (self._channel, id_, key) for key in removed ])
+        if root:
+            return
+
+        for key in [ record[0] for record in records ] + removed:
+            if key in ("date", "hidden", "order"):
+                break
+        else:
+            return
+        self._write_item(id_, self._db.execute(
+            "SELECT key, type, value FROM field "
+            "WHERE channel = ? AND item = ? AND key IN ('date', 'hidden', 'order')",
+            (self._channel, id_)))
+
+    def _write_item(self, id_, records):
+        """Write the item row for id_ from its records."""
+        date = order = None
+        hidden = 0
+        for key, type, value in records:
+            type, value = decode_value(type, value)
+            if key == "date" and type == CachedInfo.DATE:
+                date = value
+            elif key == "hidden":
+                hidden = 1
+            elif key == "order":
+                try:
+                    order = int(value)
+                except ValueError:
+                    pass
+        self._db.execute(
+            "INSERT OR REPLACE INTO item (channel, id, date, hidden, ord) "
+            "VALUES (?, ?, ?, ?, ?)", (self._channel, id_, date, hidden, order))
+
+    def clear(self, id_, root):
+        """Remove the records stored for id_."""
+        if root:
+            id_ = ""
+        else:
+            self._db.execute("DELETE FROM item WHERE channel = ? AND id = ?",
+                             (self._channel, id_))
+        self._db.execute("DELETE FROM field WHERE channel = ? AND item = ?",
+                         (self._channel, id_))
+
+    def item_ids(self, count=0):
+        """Return the ids of the items stored, newest first.
+
+        If count is given, at most that many are returned.
+        """
+        return [ row[0] for row in self._db.execute(
+            "SELECT id FROM item WHERE channel = ? "
+            "ORDER BY date DESC, id DESC LIMIT ?",
+            (self._channel, count or -1)) ]
+
+    def read_items(self, keys):
+        """Return (id, records) for every item, with only the given keys."""
+        items = {}
+        for id_ in self.item_ids():
+            items[id_] = []
+
+        for item, key, type, value, body in self._db.execute(
+            "SELECT item, key, type, field.value, body.value FROM field "
+            "LEFT JOIN body ON type = ? AND hash = field.value "
+            "WHERE channel = ? AND key IN (%s)" % ", ".join([ "?" ] * len(keys)),
+            (BODY_TAG, self._channel) + tuple(keys)):
+            if items.has_key(item):
+                items[item].append((key,) + _decode_field(type, value, body))
+        return items.items()
+
+    def item_sizes(self):
+        """Return a dictionary of the bytes each item's fields take.
+
+        The bodies an item refers to are counted as in the body table,
+        whether or not other items refer to them too.
+        """
+        sizes = {}
+        for id_, size in self._db.execute(
+            "SELECT item, SUM(LENGTH(key) + LENGTH(type) "
+            "+ LENGTH(CAST(field.value AS BLOB)) "
+            "+ IFNULL(LENGTH(body.value), 0)) FROM field "
+            "LEFT JOIN body ON type = ? AND hash = field.value "
+            "WHERE channel = ? AND item != '' GROUP BY item",
+            (BODY_TAG, self._channel)):
+            sizes[id_] = size
+        return sizes
+
+    def counts(self):
+        """Return the numbers of items and of fields, the channel's too."""
+        return (self._db.execute("SELECT COUNT(*) FROM item WHERE channel = ?",
+                                 (self._channel,)).fetchone()[0],
+                self._db.execute("SELECT COUNT(*) FROM field WHERE channel = ?",
+                                 (self._channel,)).fetchone()[0])
+
+    def link(self, url):
+        """Make the channel also available under a new URL.
+
+        The URL becomes an alias of the channel, so both see every later
+        change.  A URL that already has a channel or alias is left alone.
+        """
+        if self._db.execute("SELECT 1 FROM channel WHERE url = ? "
+                            "UNION ALL SELECT 1 FROM alias WHERE url = ?",
+                            (url, url)).fetchone() is not None:
+            return
+
+        self._db.execute("INSERT INTO alias (url, channel) VALUES (?, ?)",
+                         (url, self._channel))
+
+    def sync(self):
+        self._db.commit()
+
+    def close(self):
+        pass
+
+def _decode_field(tag, value, body):
+    """Return the type and value of a field, with the body it refers to."""
+    if tag == BODY_TAG:
+        return _read_body(body)
+    return decode_value(tag, value)
+
+def channel_files(directory):
+    """Return the (url, filename) of each channel cached in directory.
+
+    Files that aren't dbhash channel caches are skipped, and a channel
+    linked under several names is only returned once.
+    """
+    files = {}
+    names = os.listdir(directory)
+    names.sort()
+    for name in names:
+        if name.endswith(LOCK_SUFFIX):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            store = DBHashStore(path, "r")
+        except:
+            continue
+
+        try:
+            channel = {}
+            for key, type, value in store.read(None, 1):
+                channel[key] = value
+        finally:
+            store.close()
+
+        url = channel.get("configured_url") or channel.get("url")
+        if url and not files.has_key(url):
+            files[url] = path
+
+    files = files.items()
+    files.sort()
+    return files
+
+def migrate(directory, store, jobs=1):
+    """Copy the channels cached in dbhash files in directory into store.
+
+    store is a SQLiteStore.  Files that aren't channel caches are
+    skipped, as are channels the store already has, so a migration
+    that was interrupted carries on where it left off when run again.
+    Each channel is copied an item at a time and committed on its own
+    once the numbers of items and records in the store are checked
+    against those found from the keys of its file, see
+    DBHashStore.counts(); a channel that can't be read, or doesn't
+    check out, isn't committed.
+
+    With more than one job, that many processes read the files, each
+    writing a channel at a time to a snapshot in a directory beside the
+    store for this process to copy in, see _migrate_jobs().  Returns the
+    number of channels and items copied, and the (url, reason) of each
+    channel that wasn't.
+    """
+    urls = {}
+    for url in store.urls():
+        urls[url] = 1
+    files = [ (url, path) for url, path in channel_files(directory)
+              if not urls.has_key(url) ]
+
+    if jobs > 1 and len(files) > 1 and hasattr(os, "fork"):
+        return _migrate_jobs(files, store, jobs)
+
+    channels = items = 0
+    failed = []
+    for url, path in files:
+        try:
+            counts = _copy_channel(path, url, store.channel(url))
+        except KeyboardInterrupt:
+            store.rollback()
+            raise
+        except Exception, e:
+            store.rollback()
+            failed.append((url, str(e) or e.__class__.__name__))
+            continue
+
+        reason = _check_channel(store, url, counts)
+        if reason is None:
+            channels += 1
+            items += counts[0]
+        else:
+            failed.append((url, reason))
+    return channels, items, failed
+
+def _copy_channel(path, url, new):
+    """Copy the channel in the dbhash file into a channel's store.
+
+    Returns the numbers of items and records in the file.
+    """
+    old = DBHashStore(path, "r")
+    try:
+        new.write(None, 1, old.read(None, 1))
+        for id_ in old.item_ids():
+            new.write(id_, 0, old.read(id_, 0))
+        return old.counts()
+    finally:
+        old.close()
+
+def _check_channel(store, url, counts):
+    """Commit a channel just copied if the store has all of its file.
+
+    counts are the numbers of items and records in the file.  Returns
+    None if the channel was committed, otherwise why it wasn't.
+    """
+    stored = store.channel(url).counts()
+    if stored == counts:
+        store.sync()
+        return None
+
+    store.rollback()
+    return "%d items and %d records in the file, but %d and %d stored" \
+           % (counts + stored)
+
+def _migrate_jobs(files, store, jobs):
+    """Copy the channels in files into store, read by that many jobs.
+
+    Each job is a child process given the index of a file in files
+    down a pipe of its own.  It writes the channel to a snapshot named
+    after the index, then tells this process the numbers of items and
+    records in the file down a pipe shared by the jobs, and this process
+    gives it another file if there is one before copying the snapshot
+    into the store.  So the jobs read while this process writes, and
+    there are never more snapshots than jobs waiting to be copied.
+    Returns what migrate() does.
+    """
+    snapshots = store.filename + ".migrate"
+    if os.path.isdir(snapshots):
+        # Left by a migration that was interrupted
+        for name in os.listdir(snapshots):
+            os.remove(os.path.join(snapshots, name))
+    else:
+        os.mkdir(snapshots)
+
+    results, results_fd = os.pipe()
+    workers = []
+    try:
+        for job in range(min(jobs, len(files))):
+            work_fd, work = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(work)
+                os.close(results)
+                for worker in workers:
+                    worker[1].close()
+                _migrate_job(job, files, snapshots, os.fdopen(work_fd),
+                             results_fd)
+            os.close(work_fd)
+            workers.append((pid, os.fdopen(work, "w", 0)))
+        os.close(results_fd)
+
+        channels = items = 0
+        failed = []
+        waiting = range(len(files))
+        busy = {}
+        for job in range(len(workers)):
+            busy[waiting[0]] = 1
+            workers[job][1].write("%d\n" % waiting.pop(0))
+
+        results = os.fdopen(results)
+        while busy:
+            line = results.readline()
+            if not line:
+                # Every job has exited, those that were busy by dying
+                for index in busy.keys():
+                    failed.append((files[index][0], "Job reading it died"))
+                break
+
+            job, index, counts = line.split(" ", 2)
+            job, index = int(job), int(index)
+            del(busy[index])
+            if waiting:
+                busy[waiting[0]] = 1
+                workers[job][1].write("%d\n" % waiting.pop(0))
+            else:
+                workers[job][1].close()
+
+            url = files[index][0]
+            snapshot = os.path.join(snapshots, str(index))
+            if counts.find(" ") == -1:
+                failed.append((url, counts.strip()))
+            else:
+                counts = tuple(map(int, counts.split()))
+                try:
+                    import_snapshot(snapshot, store.channel)
+                    reason = _check_channel(store, url, counts)
+                except KeyboardInterrupt:
+                    store.rollback()
+                    raise
+                except Exception, e:
+                    store.rollback()
+                    reason = str(e) or e.__class__.__name__
+                if reason is None:
+                    channels += 1
+                    items += counts[0]
+                else:
+                    failed.append((url, reason))
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
+    finally:
+        for pid, work in workers:
+            work.close()
+            os.waitpid(pid, 0)
+
+    os.rmdir(snapshots)
+    return channels, items, failed
+
+def _migrate_job(job, files, snapshots, work, results):
+    """Write the channels of the files whose indexes are read from work.
+
+    Each is written to a snapshot named after the index in snapshots,
+    and the job, index and the numbers of items and records in the file,
+    or why it wasn't written, written to results as a line short enough for the
+    pipe to keep whole.  Never returns.
+    """
+    status = 1
+    try:
+        for line in iter(work.readline, ""):
+            index = int(line)
+            url, path = files[index]
+            try:
+                fd = gzip.open(os.path.join(snapshots, str(index)), "wb", 1)
+                try:
+                    fd.write(SNAPSHOT_HEADER % SNAPSHOT_FORMAT)
+                    store = DBHashStore(path, "r")
+                    try:
+                        _export_channel(fd, url, store)
+                        counts = "%d %d" % store.counts()
+                    finally:
+                        store.close()
+                    _write_entry(fd, "E")
+                finally:
+                    fd.close()
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                counts = (str(e) or e.__class__.__name__)[:200]
+                counts = counts.replace("\n", " ")
+            os.write(results, "%d %d %s\n" % (job, index, counts))
+        status = 0
+    finally:
+        os._exit(status)
+
+def export_snapshot(filename, urls, channel_store):
+    """Write the channels with the given URLs into a snapshot file.
+
+    channel_store is called with each URL for the store to read it from,
+    which is closed once it has been.  The snapshot is gzip-compressed,
+    SNAPSHOT_HEADER then an entry for each channel, item and record with
+    values encoded as they are in a cache.  It's written under a
+    temporary name and renamed into place once complete.  Returns the
+    number of items written.
+    """
+    fd = gzip.open(filename + ".tmp", "wb", 6)
+    try:
+        fd.write(SNAPSHOT_HEADER % SNAPSHOT_FORMAT)
+        items = 0
+        for url in urls:
+            store = channel_store(url)
+            try:
+                items += _export_channel(fd, url, store)[0]
+            finally:
+                store.close()
+        _write_entry(fd, "E")
+        fd.close()
+    except:
+        fd.close()
+        os.remove(filename + ".tmp")
+        raise
+
+    os.rename(filename + ".tmp", filename)
+    return items
+
+def _export_channel(fd, url, store):
+    """Write the channel in the store into a snapshot.
+
+    Returns the number of items and records written.
+    """
+    records = store.read(None, 1)
+    _write_entry(fd, "C", url)
+    _write_records(fd, records)
+    items = 0
+    count = len(records)
+    for id_ in store.item_ids():
+        records = store.read(id_, 0)
+        _write_entry(fd, "I", id_)
+        _write_records(fd, records)
+        items += 1
+        count += len(records)
+    return items, count
+
+def import_snapshot(filename, channel_store):
+    """Read the channels in a snapshot file into the cache.
+
+    channel_store is called with the URL of each channel for the store
+    to write it to, which is closed once it has been; anything it held
+    for the channel is replaced.  Returns the number of channels and
+    items read.
+    """
+    fd = gzip.open(filename, "rb")
+    try:
+        header = fd.readline()
+        if header != SNAPSHOT_HEADER % SNAPSHOT_FORMAT:
+            raise ValueError, "Not a cache snapshot of a known format: " \
+                  + header.strip()
+
+        channels = items = 0
+        store = id_ = records = None
+        while 1:
+            kind = fd.read(1)
+            if kind == "R" and records is not None:
+                key, tag, value = _read_fields(fd, 3)
+                records.append((key,) + decode_value(tag, value))
+                continue
+
+            if records is not None:
+                store.write(id_, id_ is None, records)
+            if kind == "I":
+                id_, = _read_fields(fd, 1)
+                records = []
+                items += 1
+                continue
+
+            if store is not None:
+                store.close()
+                store = None
+            if kind == "C":
+                url, = _read_fields(fd, 1)
+                store = channel_store(url)
+                for old_id in store.item_ids():
+                    store.clear(old_id, 0)
+                id_ = None
+                records = []
+                channels += 1
+            elif kind == "E":
+                return channels, items
+            else:
+                raise ValueError, "Truncated or corrupt cache snapshot"
+    finally:
+        fd.close()
+
+def write_render_index(filename, key, items):
+    """Write a render index of the items to filename.
+
+    items is a list of (date, order, url, item) in the order they're to
+    be rendered, url being that of the item's channel.  The index starts
+    with RENDER_INDEX_HEADER, the number of channels and items and the
+    channel URLs, then has a table with a fixed-size entry for each item
+    pointing into the records that follow it.  It's written under a
+    temporary name and renamed into place once complete.
+    """
+    channels = {}
+    urls = []
+    blobs = []
+    for date, order, url, item in items:
+        if not channels.has_key(url):
+            channels[url] = len(urls)
+            urls.append(url)
+        blob = [ "I", struct.pack("!L", len(item._id)), item._id ]
+        for item_key in item.keys():
+            type, value = item._record(item_key)[1:]
+            blob.append(_encode_entry("R", item_key,
+                                      *encode_value(type, value)))
+        blobs.append("".join(blob))
+
+    data = [ RENDER_INDEX_HEADER % (RENDER_INDEX_FORMAT, key),
+             struct.pack(RENDER_INDEX_COUNTS, len(urls), len(items)) ]
+    for url in urls:
+        data.append(struct.pack("!L", len(url)) + url)
+    offset = len("".join(data)) \
+             + len(items) * struct.calcsize(RENDER_INDEX_ITEM)
+    for i in range(len(items)):
+        date, order, url, item = items[i]
+        data.append(struct.pack(RENDER_INDEX_ITEM, date, order or 0,
+                                channels[url], offset, len(blobs[i])))
+        offset += len(blobs[i])
+
+    fd = open(filename + ".tmp", "wb")
+    try:
+        fd.write("".join(data))
+        for blob in blobs:
+            fd.write(blob)
+        fd.close()
+    except:
+        fd.close()
+        os.remove(filename + ".tmp")
+        raise
+    os.rename(filename + ".tmp", filename)
+
+class RenderIndex:
+    """Items to render, read from a memory-mapped render index.
+
+    The index is written by write_render_index() when the items are
+    updated, so that a run that only renders them needn't read the
+    channels' items to find and sort them.  Only the table is read
+    when the index is opened, the records of an item are decoded from
+    the mapped file when read() is asked for them, which makes this a
+    read-only store for the items listed by items().
+
+    Properties:
+        key             Key of what the index was written for.
+    """
+    def __init__(self, filename):
+        fd = open(filename, "rb")
+        try:
+            self._map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fd.close()
+
+        try:
+            end = self._map.find("\n") + 1
+            header = self._map[:end].split(" ")
+            if end == 0 or len(header) != 5 \
+                   or " ".join(header[:3]) + " %s %s\n" != RENDER_INDEX_HEADER:
+                raise ValueError, "Not a render index"
+            if header[3] != RENDER_INDEX_FORMAT:
+                raise ValueError, "Unknown render index format: " + header[3]
+            self.key = header[4].strip()
+
+            size = struct.calcsize(RENDER_INDEX_COUNTS)
+            channels, self._count = struct.unpack(RENDER_INDEX_COUNTS,
+                                                  self._map[end:end + size])
+            offset = end + size
+            self._urls = []
+            for i in range(channels):
+                size = struct.unpack("!L", self._map[offset:offset + 4])[0]
+                self._urls.append(self._map[offset + 4:offset + 4 + size])
+                offset += 4 + size
+            self._table = offset
+        except (ValueError, struct.error):
+            self._map.close()
+            raise ValueError, "Not a render index of a known format"
+
+        self._records = {}
+
+    def items(self, count=0):
+        """Return the (date, order, url, id) of the items, in order.
+
+        If count is given, at most that many are returned.
+        """
+        if not count or count > self._count:
+            count = self._count
+
+        items = []
+        size = struct.calcsize(RENDER_INDEX_ITEM)
+        for offset in range(self._table, self._table + count * size, size):
+            date, order, channel, start, length = struct.unpack(
+                RENDER_INDEX_ITEM, self._map[offset:offset + size])
+            id_size = struct.unpack("!L", self._map[start + 1:start + 5])[0]
+            id_ = self._map[start + 5:start + 5 + id_size]
+            self._records[id_] = (start + 5 + id_size, start + length)
+            items.append((date, order, self._urls[channel], id_))
+        return items
+
+    def read(self, id_, root, keys=None):
+        """Return the (key, type, value) records of an item from items()."""
+        if root or not self._records.has_key(id_):
+            return []
+
+        records = []
+        start, end = self._records[id_]
+        while start < end:
+            fields = []
+            start += 1
+            for i in range(3):
+                size = struct.unpack("!L", self._map[start:start + 4])[0]
+                fields.append(self._map[start + 4:start + 4 + size])
+                start += 4 + size
+            key, tag, value = fields
+            if keys is None or keys.has_key(key):
+                records.append((key,) + decode_value(tag, value))
+        return records
+
+    def close(self):
+        self._map.close()
+
+def _encode_entry(kind, *fields):
+    """Return an entry of a snapshot, each field prefixed by its length."""
+    data = [ kind ]
+    for field in fields:
+        data.append(struct.pack("!L", len(field)))
+        data.append(field)
+    return "".join(data)
+
+def _write_entry(fd, kind, *fields):
+    """Write an entry of a snapshot, each field prefixed by its length."""
+    fd.write(_encode_entry(kind, *fields))
+
+def _write_records(fd, records):
+    """Write the records in a snapshot, encoded as they are in a cache."""
+    for key, type, value in records:
+        _write_entry(fd, "R", key, *encode_value(type, value))
+
+def _read_fields(fd, count):
+    """Read the fields of a snapshot entry."""
+    fields = []
+    for i in range(count):
+        size = fd.read(4)
+        if len(size) == 4:
+            size = struct.unpack("!L", size)[0]
+            field = fd.read(size)
+            if len(field) == size:
+                fields.append(field)
+                continue
+        raise ValueError, "Truncated or corrupt cache snapshot"
+    return fields
+
+class ParseCache:
+    """Cache of feedparser results.
+
+    This is handed to feedparser.parse() as its result_cache, each result
+    is stored gzip-compressed in a file in the given directory named after
+    the key feedparser computed for the document.  Files are written under
+    a temporary name and renamed into place when complete, so a run that
+    dies half-way never leaves a truncated result behind.
+
+    Results not used for max_age seconds are removed by expire().
+    """
+    def __init__(self, directory, max_age=7*86400):
+        self.directory = directory
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def reader(self, key):
+        """Return a file to read the result stored under key, or None."""
+        path = os.path.join(self.directory, key)
+        try:
+            fd = gzip.open(path, "rb")
+            os.utime(path, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return fd
+
+    def writer(self, key):
+        """Return a file to store a result under key."""
+        return ParseCacheWriter(os.path.join(self.directory, key))
+
+    def expire(self):
+        """Remove results that haven't been used for max_age seconds."""
+        horizon = time.time() - self.max_age
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime < horizon:
+                    os.remove(path)
+            except OSError:
+                pass
+
+class ParseCacheWriter:
+    """Result being written to a ParseCache.
+
+    The result is only stored once close() is called; abort(), or losing
+    the writer before it's closed, throws it away.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._fd = gzip.open(path + ".tmp", "wb")
+
+    def write(self, data):
+        self._fd.write(data)
+
+    def close(self):
+        self._fd.close()
+        os.rename(self._path + ".tmp", self._path)
+        self._fd = None
+
+    def abort(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+            try:
+                os.remove(self._path + ".tmp")
+            except OSError:
+                pass
+
+    def __del__(self):
+        self.abort()
+
+class HTMLCache:
+    """Cache of sanitized HTML.
+
+    Sanitizing HTML means a full parse of it, so we keep the result in a
+    database alongside the channel caches, keyed by a hash of the HTML
+    that went in.  Each run is numbered and every result is stored with
+    the number of the run that last used it, once the total size of the
+    results is over max_size those least recently used are removed by
+    close().
+    """
+    def __init__(self, filename, max_size=16*1024*1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        self._db = dbhash.open(filename, "c")
+        if self._db.has_key(" run"):
+            self._run = int(self._db[" run"]) + 1
+            self._size = int(self._db[" size"])
+        else:
+            self._run = 1
+            self._size = 0
+        self._db[" run"] = str(self._run)
+
+    def get(self, key):
+        """Return the HTML stored under key, or None."""
+        if not self._db.has_key(key):
+            self.misses += 1
+            return None
+
+        run, value = self._db[key].split(" ", 1)
+        if int(run) != self._run:
+            self._db[key] = "%d %s" % (self._run, value)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Store the HTML under key."""
+        if self._db.has_key(key):
+            self._size -= len(self._db[key])
+        record = "%d %s" % (self._run, value)
+        self._db[key] = record
+        self._size += len(record)
+
+    def close(self):
+        """Remove the least recently used results over max_size and close."""
+        if self._size > self.max_size:
+            records = []
+            for key in self._db.keys():
+                if key.startswith(" "):
+                    continue
+                record = self._db[key]
+                records.append((int(record.split(" ", 1)[0]), key, len(record)))
+            records.sort()
+
+            for run, key, size in records:
+                if self._size <= self.max_size:
+                    break
+                del(self._db[key])
+                self._size -= size
+                self.evicted += 1
+
+        self._db[" size"] = str(self._size)
+        self._db.close()
+
 
 def filename(directory, filename):
     """Return a filename suitable for the cache.
@@ -292,6 +2240,62 @@ def filename(directory, filename):
 
     return os.path.join(directory, filename)
 
+def encode_value(type, value):
+    """Return the type tag and string to store a value in a dbhash cache.
+
+    Dates and integers are packed into as few bytes as they'll fit, with
+    VALUE_FORMAT in the tag, null is stored as an empty string and strings
+    as they are, unless they're large enough to compress (COMPRESS_MIN_SIZE)
+    in which case they're stored compressed with COMPRESSED_FORMAT in the
+    tag.  A CompressedString is stored as it was read.
+    """
+    if type == CachedInfo.NULL:
+        return type, ""
+    elif isinstance(value, CompressedString):
+        return type + ":" + COMPRESSED_FORMAT, value.data
+    elif type == CachedInfo.STRING and len(value) >= COMPRESS_MIN_SIZE:
+        data = zlib.compress(value)
+        if len(data) < len(value):
+            return type + ":" + COMPRESSED_FORMAT, data
+        return type, value
+    elif type != CachedInfo.DATE and type != CachedInfo.INT:
+        return type, value
+
+    value = int(value)
+    for size in (1, 2, 4, 8):
+        limit = 1L << (size * 8 - 1)
+        if -limit <= value < limit:
+            break
+    return type + ":" + VALUE_FORMAT, struct.pack(INT_FORMATS[size], value)
+
+def decode_value(tag, value):
+    """Return the type and value stored with the type tag.
+
+    The value is given the Python type CachedInfo keeps that type in,
+    compressed strings being left compressed as a CompressedString.
+    """
+    if tag.find(":") != -1:
+        type, format = tag.split(":", 1)
+        if format == COMPRESSED_FORMAT:
+            return type, CompressedString(str(value))
+        if format != VALUE_FORMAT:
+            raise ValueError, "Unknown cache value format: " + tag
+        value = struct.unpack(INT_FORMATS[len(value)], value)[0]
+    else:
+        type = tag
+        if type == CachedInfo.DATE and isinstance(value, str) \
+               and value.find(" ") != -1:
+            # Stored as the items of a time tuple by older versions
+            value = calendar.timegm([ int(i) for i in value.split(" ") ])
+
+    if type == CachedInfo.DATE:
+        value = float(value)
+    elif type == CachedInfo.INT:
+        value = int(value)
+    elif type == CachedInfo.NULL:
+        value = None
+    return type, value
+
 def utf8(value):
     """Return the value as a UTF-8 string."""
     if type(value) == type(u''):
@@ -56,6 +56,13 @@ ACCEPT_HEADER = "application/atom+xml,application/rdf+xml,application/rss+xml,ap
 # of pre-installed parsers until it finds one that supports everything we need.
 PREFERRED_XML_PARSERS = ["drv_libxml2"]
 
+# List of parser backends, in the order they are tried.  "strict" is the SAX
+# parser; "repair" fixes the commonest well-formedness errors (bare ampersands,
+# HTML entities, control characters) and tries the SAX parser again.  If they
+# all fail, feedparser falls back on its much slower sgmllib-based parser.
+# See registerParserBackend to add your own.
+PREFERRED_PARSER_BACKENDS = ["strict", "repair"]
+
 # If you want feedparser to automatically run HTML markup through HTML Tidy, set
 # this to 1.  Requires mxTidy <http://www.egenix.com/files/python/mxTidy.html>
 # or utidylib <http://utidylib.berlios.de/>.
@@ -66,11 +73,19 @@ TIDY_MARKUP = 0
 PREFERRED_TIDY_INTERFACES = ["uTidy", "mxTidy"]
 
 # ---------- required modules (should come with any Python distribution) ----------
-import sgmllib, re, sys, copy, urlparse, time, rfc822, types, cgi, urllib, urllib2
+import sgmllib, re, sys, copy, urlparse, time, rfc822, types, cgi, urllib, urllib2, codecs
 try:
     from cStringIO import StringIO as _StringIO
 except:
     from StringIO import StringIO as _StringIO
+try:
+    from hashlib import md5 as _md5
+except:
+    from md5 import new as _md5
+try:
+    import cPickle as pickle
+except:
+    import pickle
 
 # ---------- optional modules (feedparser will work without these, but with reduced functionality) ----------
 
@@ -384,6 +399,7 @@ class _FeedParserMixin:
     can_contain_relative_uris = ['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description']
     can_contain_dangerous_markup = ['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description']
     html_types = ['text/html', 'application/xhtml+xml']
+    html_processor = None # see parse()
     
     def __init__(self, baseuri=None, baselang=None, encoding='utf-8'):
         if _debug: sys.stderr.write('initializing FeedParser\n')
@@ -686,15 +702,22 @@ class _FeedParserMixin:
         except KeyError:
             pass
 
-        # resolve relative URIs within embedded markup
-        if self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types:
-            if element in self.can_contain_relative_uris:
-                output = _resolveRelativeURIs(output, self.baseuri, self.encoding)
-        
-        # sanitize embedded markup
-        if self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types:
-            if element in self.can_contain_dangerous_markup:
-                output = _sanitizeHTML(output, self.encoding)
+        contentType = self.mapContentType(self.contentparams.get('type', 'text/html'))
+        if self.html_processor and contentType == 'text/html' and \
+           element in self.can_contain_relative_uris and \
+           element in self.can_contain_dangerous_markup:
+            # resolve relative URIs within and sanitize embedded markup in one go
+            output = self.html_processor(output, self.baseuri, self.encoding)
+        else:
+            # resolve relative URIs within embedded markup
+            if contentType in self.html_types:
+                if element in self.can_contain_relative_uris:
+                    output = _resolveRelativeURIs(output, self.baseuri, self.encoding)
+
+            # sanitize embedded markup
+            if contentType in self.html_types:
+                if element in self.can_contain_dangerous_markup:
+                    output = _sanitizeHTML(output, self.encoding)
 
         if self.encoding and type(output) != type(u''):
             try:
@@ -1667,8 +1690,33 @@ class _RelativeURIResolver(_BaseHTMLProcessor):
         attrs = [(key, ((tag, key) in self.relative_uris) and self.resolveURI(value) or value) for key, value in attrs]
         _BaseHTMLProcessor.unknown_starttag(self, tag, attrs)
         
+# attributes that _RelativeURIResolver may rewrite, whatever the element, and
+# the values _urljoin is guaranteed to leave alone
+_relative_uri_attr = re.compile(r'''[\s'"](?:action|background|cite|classid|codebase|data|href|longdesc|profile|src|usemap)(?![-.:\w])\s*(?:=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]*)))?''', re.IGNORECASE)
+_absolute_uri = re.compile(r'[a-z][-+.a-z0-9]*://[-.%\w][^\s&;]*(?<![?#])$')
+
+# number of embedded HTML blocks handed to _resolveRelativeURIs that were
+# parsed, and that were returned untouched because they had no relative URIs
+RESOLVE_STATS = {'parsed': 0, 'fast': 0}
+
+def _hasRelativeURIs(htmlSource):
+    '''Cheaply check whether markup may contain a relative URI to resolve
+
+    Errs on the side of caution: anything that looks like a resolvable
+    attribute without a plain absolute URI for its value counts as relative.
+    '''
+    for match in _relative_uri_attr.finditer(htmlSource):
+        values = [v for v in match.groups() if v is not None]
+        if not values or not _absolute_uri.match(values[0]):
+            return 1
+    return 0
+
 def _resolveRelativeURIs(htmlSource, baseURI, encoding):
     if _debug: sys.stderr.write('entering _resolveRelativeURIs\n')
+    if not _hasRelativeURIs(htmlSource):
+        RESOLVE_STATS['fast'] += 1
+        return htmlSource
+    RESOLVE_STATS['parsed'] += 1
     p = _RelativeURIResolver(baseURI, encoding)
     p.feed(htmlSource)
     return p.output()
@@ -1696,6 +1744,9 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
 
     unacceptable_elements_with_end_tag = ['script', 'applet']
 
+    # ampersands sgmllib passes on as data, which don't start a reference
+    _r_bareamp = re.compile(r'&(?!#\d+;|#x[0-9a-fA-F]+;|\w+;)')
+
     def reset(self):
         _BaseHTMLProcessor.reset(self)
         self.unacceptablestack = 0
@@ -1724,7 +1775,7 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
 
     def handle_data(self, text):
         if not self.unacceptablestack:
-            _BaseHTMLProcessor.handle_data(self, text)
+            _BaseHTMLProcessor.handle_data(self, self._r_bareamp.sub('&amp;', text))
 
 def _sanitizeHTML(htmlSource, encoding):
     p = _HTMLSanitizer(encoding)
@@ -2497,10 +2548,21 @@ def _toUTF8(data, encoding):
                 sys.stderr.write('trying utf-32le instead\n')
         encoding = 'utf-32le'
         data = data[4:]
-    newdata = unicode(data, encoding)
-    if _debug: sys.stderr.write('successfully converted %s data to unicode\n' % encoding)
     declmatch = re.compile('^<\?xml[^>]*?>')
     newdecl = '''<?xml version='1.0' encoding='utf-8'?>'''
+    if codecs.lookup(encoding)[0] is codecs.lookup('utf-8')[0]:
+        # already UTF-8, so just check that it is, a piece at a time rather
+        # than holding the whole document as Unicode
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for i in range(0, len(data), _CHUNK_SIZE):
+            decoder.decode(data[i:i + _CHUNK_SIZE])
+        decoder.decode('', 1)
+        if _debug: sys.stderr.write('successfully checked %s data\n' % encoding)
+        if declmatch.search(data):
+            return declmatch.sub(newdecl, data)
+        return newdecl + '\n' + data
+    newdata = unicode(data, encoding)
+    if _debug: sys.stderr.write('successfully converted %s data to unicode\n' % encoding)
     if declmatch.search(newdata):
         newdata = declmatch.sub(newdecl, newdata)
     else:
@@ -2524,9 +2586,310 @@ def _stripDoctype(data):
         version = None
     data = doctype_pattern.sub('', data)
     return version, data
-    
-def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[]):
-    '''Parse a feed from a URL, file, stream, or string'''
+
+# Amount of data the SAX parser is given at a time, between each of which the
+# entries it has finished are handed out
+_CHUNK_SIZE = 16384
+
+def _iterStrict(data, baseuri, baselang, html_processor=None):
+    '''Parse well-formed UTF-8 data with the SAX parser, a piece at a time
+
+    Yields the parser after each piece, so the entries it has finished can be
+    taken before the whole document is parsed.
+    '''
+    feedparser = _StrictFeedParser(baseuri, baselang, 'utf-8')
+    feedparser.html_processor = html_processor
+    saxparser = xml.sax.make_parser(PREFERRED_XML_PARSERS)
+    saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
+    saxparser.setContentHandler(feedparser)
+    saxparser.setErrorHandler(feedparser)
+    if hasattr(saxparser, '_ns_stack'):
+        # work around bug in built-in SAX parser (doesn't recognize xml: namespace)
+        # PyXML doesn't have this problem, and it doesn't have _ns_stack either
+        saxparser._ns_stack.append({'http://www.w3.org/XML/1998/namespace':'xml'})
+    try:
+        if isinstance(saxparser, xml.sax.xmlreader.IncrementalParser):
+            for i in range(0, len(data), _CHUNK_SIZE):
+                saxparser.feed(data[i:i + _CHUNK_SIZE])
+                yield feedparser
+            saxparser.close()
+        else:
+            source = xml.sax.xmlreader.InputSource()
+            source.setByteStream(_StringIO(data))
+            saxparser.parse(source)
+    except Exception, e:
+        if _debug:
+            import traceback
+            traceback.print_stack()
+            traceback.print_exc()
+            sys.stderr.write('xml parsing failed\n')
+        raise feedparser.exc or e
+    yield feedparser
+
+_cdata_section = re.compile(r'(<!\[CDATA\[.*?\]\]>)', re.DOTALL)
+_bare_ampersand = re.compile(r'&(?!#\d+;|#x[0-9a-fA-F]+;|[a-zA-Z][-.\w]*;)')
+_named_entity = re.compile(r'&([a-zA-Z][-.\w]*);')
+_invalid_xml_chars = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def _replaceNamedEntity(match):
+    name = match.group(1)
+    if name in ('lt', 'gt', 'amp', 'quot', 'apos'):
+        return match.group(0)
+    import htmlentitydefs
+    if hasattr(htmlentitydefs, 'name2codepoint') and htmlentitydefs.name2codepoint.has_key(name):
+        return '&#%d;' % htmlentitydefs.name2codepoint[name]
+    return '&amp;%s;' % name
+
+def _repairXML(data):
+    '''Fix the commonest well-formedness errors in a document
+
+    Escapes bare ampersands, turns HTML entities into character references
+    and strips control characters XML doesn't allow, leaving CDATA sections
+    alone.
+    '''
+    pieces = _cdata_section.split(_invalid_xml_chars.sub('', data))
+    for i in range(0, len(pieces), 2):
+        pieces[i] = _named_entity.sub(_replaceNamedEntity, _bare_ampersand.sub('&amp;', pieces[i]))
+    return ''.join(pieces)
+
+def _iterRepaired(data, baseuri, baselang, html_processor=None):
+    '''Repair the document, then parse it strictly
+
+    This covers most ill-formed feeds we see in the wild at the cost of a
+    few regular expressions, instead of a full sgmllib parse.
+    '''
+    repaired = _repairXML(data)
+    if repaired == data:
+        raise ValueError('nothing to repair')
+    for feedparser in _iterStrict(repaired, baseuri, baselang, html_processor):
+        yield feedparser
+
+def _resultCacheKey(data, baseuri, baselang, encoding, html_processor_version):
+    '''Return the key a parse result is cached under
+
+    The key is a hash of the decoded document along with everything else
+    that goes into parsing it, so a change of settings never returns a
+    result parsed under the old ones.
+    '''
+    key = _md5()
+    for setting in (__version__, ' '.join(PREFERRED_PARSER_BACKENDS), TIDY_MARKUP,
+                    html_processor_version,
+                    baseuri or '', baselang or '', encoding):
+        key.update('%r\0' % setting)
+    key.update(data)
+    return key.hexdigest()
+
+_parser_backends = {'strict': _iterStrict,
+                    'repair': _iterRepaired}
+def registerParserBackend(name, func):
+    '''Register a parser backend function
+
+    The function takes the document (as UTF-8 with an XML declaration), the
+    base URI, the base language and the html_processor given to parse(), to
+    set on the parser, and returns an iterator over a
+    _FeedParserMixin instance, yielding it whenever it may have finished more
+    entries and once more when it has finished the document; it raises an
+    exception if it can't parse the document.  Add the name to
+    PREFERRED_PARSER_BACKENDS to use it.
+    '''
+    _parser_backends[name] = func
+
+def _takeEntries(feedparser):
+    '''Remove and return the entries the parser has finished'''
+    finished = len(feedparser.entries)
+    if feedparser.inentry:
+        finished -= 1
+    entries = feedparser.entries[:finished]
+    del feedparser.entries[:finished]
+    return entries
+
+def _finishResult(result, parsed):
+    '''Fill in the result from what parsing the document gave us'''
+    result['feed'] = parsed['feed']
+    result['version'] = result['version'] or parsed['version']
+    result['namespaces'] = parsed['namespaces']
+    if parsed['bozo_exception']:
+        result['bozo'] = 1
+        result['bozo_exception'] = parsed['bozo_exception']
+
+def _writeRecord(writer, record):
+    '''Write a record to a result cache writer, dropping the writer on error'''
+    if writer is None:
+        return None
+    try:
+        try:
+            data = pickle.dumps(record, 2)
+        except (pickle.PicklingError, TypeError):
+            # parse errors can hold on to the parser; keep only the message
+            kind, parsed = record
+            parsed = parsed.copy()
+            parsed['bozo_exception'] = Exception(str(parsed['bozo_exception']))
+            data = pickle.dumps((kind, parsed), 2)
+        writer.write(data)
+    except Exception, e:
+        if _debug: sys.stderr.write('could not cache parse result: %s\n' % e)
+        writer.abort()
+        return None
+    return writer
+
+def _iterLoose(data, baseuri, baselang, encoding, html_processor=None):
+    '''Parse the document with the sgmllib-based parser, all in one go'''
+    feedparser = _LooseFeedParser(baseuri, baselang, encoding)
+    feedparser.html_processor = html_processor
+    feedparser.feed(data)
+    yield feedparser
+
+def _iterEntries(state, data, baseuri, baselang, use_strict_parser, known_encoding, result_cache, html_processor, html_processor_version):
+    '''Parse the document, yielding the entries as they are finished
+
+    state['feed'] is kept up to date with the feed information parsed so far,
+    and state['parsed'] is set to the finished feed, version, namespaces and
+    the error the first parser backend gave (if any) at the end.
+
+    The result cache holds a stream of pickled records: ('feed', feed) as it
+    was when the first entry was finished, ('entry', entry) for each entry and
+    ('end', parsed).  If reading the cache or a parser backend fails part of
+    the way through, the next way of parsing the document starts over and
+    the entries already handed out are skipped.
+    '''
+    encoding = known_encoding and 'utf-8' or ''
+    yielded = 0
+    written = 0
+    writer = None
+    if result_cache is not None:
+        cache_key = _resultCacheKey(data, baseuri, baselang, encoding,
+                                    html_processor and html_processor_version)
+        reader = result_cache.reader(cache_key)
+        if reader is not None:
+            try:
+                while 1:
+                    kind, value = pickle.load(reader)
+                    if kind == 'feed':
+                        state['feed'] = value
+                    elif kind == 'entry':
+                        yielded += 1
+                        yield value
+                    else:
+                        state['parsed'] = value
+                        reader.close()
+                        return
+            except Exception, e:
+                if _debug: sys.stderr.write('could not read cached parse result: %s\n' % e)
+                reader.close()
+        writer = result_cache.writer(cache_key)
+
+    # try each parser backend in turn, reporting why the first one failed, and
+    # fall back on the loose parser if they all fail
+    backends = []
+    if use_strict_parser:
+        for backend in PREFERRED_PARSER_BACKENDS:
+            backends.append((backend, _parser_backends[backend]))
+    backends.append(('loose', lambda data, baseuri, baselang, html_processor: _iterLoose(data, baseuri, baselang, encoding, html_processor)))
+    parse_error = None
+    for backend, func in backends:
+        taken = 0
+        try:
+            for feedparser in func(data, baseuri, baselang, html_processor):
+                state['feed'] = feedparser.feeddata
+                for entry in _takeEntries(feedparser):
+                    taken += 1
+                    if taken > written:
+                        if not written:
+                            writer = _writeRecord(writer, ('feed', feedparser.feeddata))
+                        writer = _writeRecord(writer, ('entry', entry))
+                        written += 1
+                    if taken > yielded:
+                        yielded += 1
+                        yield entry
+            break
+        except Exception, e:
+            if backend == 'loose':
+                if writer is not None:
+                    writer.abort()
+                raise
+            if _debug: sys.stderr.write('%s parser backend failed: %s\n' % (backend, e))
+            if parse_error is None:
+                parse_error = e
+
+    state['parsed'] = {'feed': feedparser.feeddata,
+                       'version': feedparser.version,
+                       'namespaces': feedparser.namespacesInUse,
+                       'bozo_exception': parse_error}
+    writer = _writeRecord(writer, ('end', state['parsed']))
+    if writer is not None:
+        writer.close()
+
+class _EntryStream:
+    '''The entries of a feed, handed out as they are parsed
+
+    The first entry is parsed as soon as the stream is made, so it's true
+    if the feed has any entries at all.  The result is filled in as the
+    entries are parsed.
+    '''
+    def __init__(self, result, data, baseuri, baselang, use_strict_parser, known_encoding, result_cache, html_processor, html_processor_version):
+        # the generator mustn't refer to the result, which refers to us: a
+        # cycle holding a suspended generator can never be collected
+        self._result = result
+        self._state = {}
+        self._entries = _iterEntries(self._state, data, baseuri, baselang,
+                                     use_strict_parser, known_encoding, result_cache,
+                                     html_processor, html_processor_version)
+        self._pending = []
+        try:
+            self._pending.append(self.next())
+        except StopIteration:
+            pass
+        self._any = len(self._pending)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._pending:
+            return self._pending.pop()
+        try:
+            entry = self._entries.next()
+        except StopIteration:
+            if self._state.has_key('parsed'):
+                _finishResult(self._result, self._state['parsed'])
+                del self._state['parsed']
+            raise
+        self._result['feed'] = self._state['feed']
+        return entry
+
+    def __nonzero__(self):
+        return self._any
+
+def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], result_cache=None, html_processor=None, html_processor_version=''):
+    '''Parse a feed from a URL, file, stream, or string
+
+    If result_cache is given, the parse result of each document is kept in it
+    so the same document is never parsed twice.  It is an object with two
+    methods: reader(key) returns a file-like object to read the result stored
+    under key from, or None; writer(key) returns a file-like object to store
+    the result under key, with close() to keep it and abort() to drop it.
+
+    If you resolve relative URIs in and sanitize embedded text/html markup
+    yourself, pass html_processor, a function taking the markup, the base URI
+    and the encoding and returning the result; it will be used instead of the
+    built-in functions, saving parsing the markup twice.  Pass
+    html_processor_version too, something that changes whenever the
+    function's output does, so results cached from an earlier version aren't
+    used.
+    '''
+    result = iterparse(url_file_stream_or_string, etag, modified, agent, referrer, handlers, result_cache, html_processor, html_processor_version)
+    result['entries'] = list(result['entries'])
+    return result
+
+def iterparse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], result_cache=None, html_processor=None, html_processor_version=''):
+    '''Parse a feed, handing out its entries as they are parsed
+
+    Takes the same arguments as parse(), but result['entries'] is an iterator
+    over the entries, which are parsed as they're asked for, so only a few of
+    them are held in memory at a time.  It is true if the feed has any entries.
+    Until it is exhausted, result['feed'] holds what came before the first
+    entry, and 'version', 'namespaces' and the parse error (if any) aren't set.
+    '''
     result = FeedParserDict()
     result['feed'] = FeedParserDict()
     result['entries'] = []
@@ -2673,37 +3036,10 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
 
     if not _XML_AVAILABLE:
         use_strict_parser = 0
-    if use_strict_parser:
-        # initialize the SAX parser
-        feedparser = _StrictFeedParser(baseuri, baselang, 'utf-8')
-        saxparser = xml.sax.make_parser(PREFERRED_XML_PARSERS)
-        saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
-        saxparser.setContentHandler(feedparser)
-        saxparser.setErrorHandler(feedparser)
-        source = xml.sax.xmlreader.InputSource()
-        source.setByteStream(_StringIO(data))
-        if hasattr(saxparser, '_ns_stack'):
-            # work around bug in built-in SAX parser (doesn't recognize xml: namespace)
-            # PyXML doesn't have this problem, and it doesn't have _ns_stack either
-            saxparser._ns_stack.append({'http://www.w3.org/XML/1998/namespace':'xml'})
-        try:
-            saxparser.parse(source)
-        except Exception, e:
-            if _debug:
-                import traceback
-                traceback.print_stack()
-                traceback.print_exc()
-                sys.stderr.write('xml parsing failed\n')
-            result['bozo'] = 1
-            result['bozo_exception'] = feedparser.exc or e
-            use_strict_parser = 0
-    if not use_strict_parser:
-        feedparser = _LooseFeedParser(baseuri, baselang, known_encoding and 'utf-8' or '')
-        feedparser.feed(data)
-    result['feed'] = feedparser.feeddata
-    result['entries'] = feedparser.entries
-    result['version'] = result['version'] or feedparser.version
-    result['namespaces'] = feedparser.namespacesInUse
+
+    result['entries'] = _EntryStream(result, data, baseuri, baselang,
+                                     use_strict_parser, known_encoding, result_cache,
+                                     html_processor, html_processor_version)
     return result
 
 if __name__ == '__main__':
@@ -6,7 +6,7 @@ __author__ = ["Mark Pilgrim <http://diveintomark.org/>",
               "Aaron Swartz <http://www.aaronsw.com/>"]
 __contributors__ = ["Sam Ruby <http://intertwingly.net/>"]
 __license__ = "BSD"
-__version__ = "0.25"
+__version__ = "0.26"
 
 _debug = 0
 
@@ -19,7 +19,16 @@ TIDY_MARKUP = 0
 # if TIDY_MARKUP = 1
 PREFERRED_TIDY_INTERFACES = ["uTidy", "mxTidy"]
 
-import sgmllib, re
+# Most results of HTML Tidy to keep in memory, so markup seen more than once
+# is only tidied once.  Only useful if TIDY_MARKUP = 1
+TIDY_CACHE_SIZE = 1000
+
+import sgmllib, re, urlparse, htmlentitydefs
+
+try:
+    from hashlib import md5 as _md5
+except:
+    from md5 import new as _md5
 
 # chardet library auto-detects character encodings
 # Download from http://chardet.feedparser.org/
@@ -34,6 +43,13 @@ except:
     chardet = None
     _chardet = lambda data: None
 
+def _lookup(names):
+    """Return a dictionary with names as its keys, to test membership of."""
+    table = {}
+    for name in names:
+        table[name] = 1
+    return table
+
 class _BaseHTMLProcessor(sgmllib.SGMLParser):
     elements_no_end_tag = ['area', 'base', 'basefont', 'br', 'col', 'frame', 'hr',
       'img', 'input', 'isindex', 'link', 'meta', 'param']
@@ -41,7 +57,9 @@ class _BaseHTMLProcessor(sgmllib.SGMLParser):
     _r_barebang = re.compile(r'<!((?!DOCTYPE|--|\[))', re.IGNORECASE)
     _r_bareamp = re.compile("&(?!#\d+;|#x[0-9a-fA-F]+;|\w+;)")
     _r_shorttag = re.compile(r'<([^<\s]+?)\s*/>')
-    
+
+    _no_end_tag = _lookup(elements_no_end_tag)
+
     def __init__(self, encoding):
         self.encoding = encoding
         if _debug: sys.stderr.write('entering BaseHTMLProcessor, encoding=%s\n' % self.encoding)
@@ -66,6 +84,133 @@ class _BaseHTMLProcessor(sgmllib.SGMLParser):
             data = data.encode(self.encoding)
         sgmllib.SGMLParser.feed(self, data)
 
+    # sgmllib looks for start_, do_ and end_ methods for every tag it sees,
+    # we have none so these tokenize the same way without the lookups.
+    # Only what we need is handled: no literal mode, no element stack.
+    def goahead(self, end):
+        rawdata = self.rawdata
+        i = 0
+        n = len(rawdata)
+        interesting = sgmllib.interesting.search
+        starttagopen = sgmllib.starttagopen.match
+        endbracket = sgmllib.endbracket.search
+        charref = sgmllib.charref.match
+        entityref = sgmllib.entityref.match
+        handle_data = self.handle_data
+        while i < n:
+            match = interesting(rawdata, i)
+            if match: j = match.start()
+            else: j = n
+            if i < j:
+                handle_data(rawdata[i:j])
+            i = j
+            if i == n: break
+            if rawdata[i] == '<':
+                if starttagopen(rawdata, i):
+                    k = self.parse_starttag(i)
+                    if k < 0: break
+                    i = k
+                    continue
+                if rawdata.startswith('</', i):
+                    match = endbracket(rawdata, i+1)
+                    if not match: break
+                    j = match.start()
+                    tag = rawdata[i+2:j].strip().lower()
+                    if rawdata[j] == '>':
+                        j = j+1
+                    self.unknown_endtag(tag)
+                    i = j
+                    continue
+                if rawdata.startswith('<!--', i):
+                    k = self.parse_comment(i)
+                    if k < 0: break
+                    i = k
+                    continue
+                if rawdata.startswith('<?', i):
+                    k = self.parse_pi(i)
+                    if k < 0: break
+                    i = i+k
+                    continue
+                if rawdata.startswith('<!', i):
+                    k = self.parse_declaration(i)
+                    if k < 0: break
+                    i = k
+                    continue
+            else:
+                match = charref(rawdata, i)
+                if match:
+                    self.handle_charref(match.group(1))
+                    i = match.end()
+                    if rawdata[i-1] != ';': i = i-1
+                    continue
+                match = entityref(rawdata, i)
+                if match:
+                    self.handle_entityref(match.group(1))
+                    i = match.end()
+                    if rawdata[i-1] != ';': i = i-1
+                    continue
+            match = sgmllib.incomplete.match(rawdata, i)
+            if not match:
+                handle_data(rawdata[i])
+                i = i+1
+                continue
+            j = match.end()
+            if j == n:
+                break
+            handle_data(rawdata[i:j])
+            i = j
+        if end and i < n:
+            handle_data(rawdata[i:n])
+            i = n
+        self.rawdata = rawdata[i:]
+
+    def parse_starttag(self, i):
+        rawdata = self.rawdata
+        if sgmllib.shorttagopen.match(rawdata, i):
+            # <tag/data/ is short for <tag>data</tag>
+            match = sgmllib.shorttag.match(rawdata, i)
+            if not match:
+                return -1
+            tag, data = match.group(1, 2)
+            tag = tag.lower()
+            self.unknown_starttag(tag, [])
+            self.handle_data(data)
+            self.unknown_endtag(tag)
+            return match.end()
+        match = sgmllib.endbracket.search(rawdata, i+1)
+        if not match:
+            return -1
+        j = match.start()
+        if rawdata[i+1] == '>':
+            # <> is short for the last tag seen
+            k = j
+            tag = self.lasttag
+        else:
+            k = sgmllib.tagfind.match(rawdata, i+1).end()
+            tag = rawdata[i+1:k].lower()
+            self.lasttag = tag
+        attrs = []
+        attrfind = sgmllib.attrfind.match
+        while k < j:
+            match = attrfind(rawdata, k)
+            if not match: break
+            attrname, rest, attrvalue = match.group(1, 2, 3)
+            if not rest:
+                attrvalue = attrname
+            else:
+                if (attrvalue[:1] == "'" == attrvalue[-1:] or
+                    attrvalue[:1] == '"' == attrvalue[-1:]):
+                    attrvalue = attrvalue[1:-1]
+                if '&' in attrvalue:
+                    attrvalue = self.entity_or_charref.sub(self._convert_ref,
+                                                           attrvalue)
+            attrs.append((attrname.lower(), attrvalue))
+            k = match.end()
+        if rawdata[j] == '>':
+            j = j+1
+        self.unknown_starttag(tag, attrs)
+        return j
+
     def normalize_attrs(self, attrs):
         # utility method to be called by descendants
         attrs = [(k.lower(), v) for k, v in attrs]
@@ -84,7 +229,7 @@ class _BaseHTMLProcessor(sgmllib.SGMLParser):
                 value = unicode(value, self.encoding)
             uattrs.append((unicode(key, self.encoding), value))
         strattrs = u''.join([u' %s="%s"' % (key, value) for key, value in uattrs]).encode(self.encoding)
-        if tag in self.elements_no_end_tag:
+        if tag in self._no_end_tag:
             self.pieces.append('<%(tag)s%(strattrs)s />' % locals())
         else:
             self.pieces.append('<%(tag)s%(strattrs)s>' % locals())
@@ -92,7 +237,7 @@ class _BaseHTMLProcessor(sgmllib.SGMLParser):
     def unknown_endtag(self, tag):
         # called for each end tag, e.g. for </pre>, tag will be 'pre'
         # Reconstruct the original end tag.
-        if tag not in self.elements_no_end_tag:
+        if tag not in self._no_end_tag:
             self.pieces.append("</%(tag)s>" % locals())
 
     def handle_charref(self, ref):
@@ -173,7 +318,16 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
       'usemap', 'valign', 'value', 'vspace', 'width']
 
     ignorable_elements = ['script', 'applet', 'style']
-            
+
+    _ignorable = _lookup(ignorable_elements)
+
+    def __init__(self, encoding, policy=None):
+        if policy is None:
+            policy = DEFAULT_POLICY
+        self._elements = policy.elements
+        self._attributes = policy.attributes
+        _BaseHTMLProcessor.__init__(self, encoding)
+
     def reset(self):
         _BaseHTMLProcessor.reset(self)
         self.tag_stack = []
@@ -185,29 +339,29 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
             _BaseHTMLProcessor.unknown_endtag(self, self.tag_stack.pop())
         
     def unknown_starttag(self, tag, attrs):
-        if tag in self.ignorable_elements:
+        if tag in self._ignorable:
             self.ignore_level += 1
             return
         
         if self.ignore_level:
             return
         
-        if tag in self.acceptable_elements:
+        if tag in self._elements:
             attrs = self.normalize_attrs(attrs)
-            attrs = [(key, value) for key, value in attrs if key in self.acceptable_attributes]
-            if tag not in self.elements_no_end_tag:
+            attrs = [(key, value) for key, value in attrs if key in self._attributes]
+            if tag not in self._no_end_tag:
                 self.tag_stack.append(tag)
             _BaseHTMLProcessor.unknown_starttag(self, tag, attrs)
         
     def unknown_endtag(self, tag):
-        if tag in self.ignorable_elements:
+        if tag in self._ignorable:
             self.ignore_level -= 1
             return
         
         if self.ignore_level:
             return
         
-        if tag in self.acceptable_elements and tag not in self.elements_no_end_tag:
+        if tag in self._elements and tag not in self._no_end_tag:
             match = False
             while self.tag_stack:
                 top = self.tag_stack.pop()
@@ -230,45 +384,272 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
             text = text.replace('<', '')
             _BaseHTMLProcessor.handle_data(self, text)
 
-def HTML(htmlSource, encoding='utf8'):
-    p = _HTMLSanitizer(encoding)
-    p.feed(htmlSource)
-    data = p.output()
-    if TIDY_MARKUP:
-        # loop through list of preferred Tidy interfaces looking for one that's installed,
-        # then set up a common _tidy function to wrap the interface-specific API.
-        _tidy = None
-        for tidy_interface in PREFERRED_TIDY_INTERFACES:
-            try:
-                if tidy_interface == "uTidy":
-                    from tidy import parseString as _utidy
-                    def _tidy(data, **kwargs):
-                        return str(_utidy(data, **kwargs))
-                    break
-                elif tidy_interface == "mxTidy":
-                    from mx.Tidy import Tidy as _mxtidy
-                    def _tidy(data, **kwargs):
-                        nerrors, nwarnings, data, errordata = _mxtidy.tidy(data, **kwargs)
-                        return data
-                    break
-            except:
-                pass
-        if _tidy:
-            utf8 = type(data) == type(u'')
-            if utf8:
-                data = data.encode('utf-8')
+class Policy:
+    """What the sanitizer lets through.
+
+    Elements and attributes default to those of _HTMLSanitizer, a planet
+    can give its own lists instead.  They're turned into dictionaries once
+    here so each check while sanitizing is a single lookup, and version
+    identifies the lists so sanitized HTML cached under one policy isn't
+    used under another.  Script, applet and style elements are never let
+    through whatever the lists say.
+    """
+    def __init__(self, elements=None, attributes=None):
+        if elements is None:
+            elements = _HTMLSanitizer.acceptable_elements
+        if attributes is None:
+            attributes = _HTMLSanitizer.acceptable_attributes
+
+        self.elements = _lookup([e.lower() for e in elements])
+        for element in _HTMLSanitizer.ignorable_elements:
+            if self.elements.has_key(element):
+                del(self.elements[element])
+        self.attributes = _lookup([a.lower() for a in attributes])
+
+        elements = self.elements.keys()
+        elements.sort()
+        attributes = self.attributes.keys()
+        attributes.sort()
+        self.version = _md5("%s\n%s" % (" ".join(elements),
+                                         " ".join(attributes))).hexdigest()[:8]
+
+DEFAULT_POLICY = Policy()
+
+class _FeedHTMLSanitizer(_HTMLSanitizer):
+    """Sanitizer for markup from feedparser that also resolves relative URIs.
+
+    This does in a single parse what feedparser's _resolveRelativeURIs and
+    _sanitizeHTML followed by _HTMLSanitizer used to do in three, so it has
+    to share their quirks: the contents of script and applet elements are
+    dropped without hiding any tags in them, style elements are dropped but
+    their contents kept, numeric references to quotes are replaced by the
+    quotes and references to unknown entities are escaped.  Quotes in
+    attribute values are escaped though, which they never were.
+    """
+    relative_uris = [('a', 'href'),
+                     ('applet', 'codebase'),
+                     ('area', 'href'),
+                     ('blockquote', 'cite'),
+                     ('body', 'background'),
+                     ('del', 'cite'),
+                     ('form', 'action'),
+                     ('frame', 'longdesc'),
+                     ('frame', 'src'),
+                     ('iframe', 'longdesc'),
+                     ('iframe', 'src'),
+                     ('head', 'profile'),
+                     ('img', 'longdesc'),
+                     ('img', 'src'),
+                     ('img', 'usemap'),
+                     ('input', 'src'),
+                     ('input', 'usemap'),
+                     ('ins', 'cite'),
+                     ('link', 'href'),
+                     ('object', 'classid'),
+                     ('object', 'codebase'),
+                     ('object', 'data'),
+                     ('object', 'usemap'),
+                     ('q', 'cite'),
+                     ('script', 'src')]
+
+    unacceptable_elements_with_end_tag = ['script', 'applet']
+
+    _relative_uris = {}
+    for tag, attr in relative_uris:
+        _relative_uris.setdefault(tag, {})[attr] = 1
+    del tag, attr
+    _unacceptable = _lookup(unacceptable_elements_with_end_tag)
+
+    _r_urifixer = re.compile('^([A-Za-z][A-Za-z0-9+-.]*://)(/*)(.*?)')
+    # URIs urljoin is guaranteed to leave alone, whatever the base
+    _r_absolute_uri = re.compile(r'[a-z][-+.a-z0-9]*://[-.%\w][^\s&;]*(?<![?#])$')
+
+    def __init__(self, encoding, baseuri, policy=None):
+        _HTMLSanitizer.__init__(self, encoding, policy)
+        self.baseuri = baseuri
+
+    def reset(self):
+        _HTMLSanitizer.reset(self)
+        self.unacceptablestack = 0
+
+    def feed(self, data):
+        # Bare ampersands are escaped as they're passed on as data, so
+        # those in dropped script elements don't turn up as references
+        data = self._r_barebang.sub(r'&lt;!\1', data)
+        data = self._r_shorttag.sub(self._shorttag_replace, data)
+        data = data.replace('&#39;', "'")
+        data = data.replace('&#34;', '"')
+        if self.encoding and type(data) == type(u''):
+            data = data.encode(self.encoding)
+        sgmllib.SGMLParser.feed(self, data)
+
+        # A tag left incomplete at the end was always lost, but only after
+        # trailing whitespace was stripped from around it; anything else
+        # left over gets passed on as data
+        incomplete = self.rawdata.startswith('<') and not self.unacceptablestack
+        if self.rawdata.startswith('<'):
+            self.rawdata = ''
+        sgmllib.SGMLParser.close(self)
+
+        if not incomplete:
+            while self.pieces and not self.pieces[-1].strip():
+                self.pieces.pop()
+            if self.pieces:
+                self.pieces[-1] = self.pieces[-1].rstrip()
+        while self.tag_stack:
+            _BaseHTMLProcessor.unknown_endtag(self, self.tag_stack.pop())
+
+    def resolveURI(self, uri):
+        if self._r_absolute_uri.match(uri):
+            return uri
+        return urlparse.urljoin(self.baseuri, self._r_urifixer.sub(r'\1\3', uri))
+
+    def unknown_starttag(self, tag, attrs):
+        if not tag in self._elements:
+            if tag in self._unacceptable:
+                self.unacceptablestack += 1
+            return
+
+        relative = self._relative_uris.get(tag, {})
+        attributes = self._attributes
+        kept = []
+        for key, value in attrs:
+            key = key.lower()
+            if key not in attributes:
+                continue
+            if key == 'rel' or key == 'type':
+                value = value.lower()
+            elif key in relative and self.baseuri is not None:
+                value = self.resolveURI(value) or value
+            # Unescaped by sgmllib, and the value is put back between them
+            kept.append((key, value.replace('"', '&quot;')))
+        if tag not in self._no_end_tag:
+            self.tag_stack.append(tag)
+        _BaseHTMLProcessor.unknown_starttag(self, tag, kept)
+
+    def unknown_endtag(self, tag):
+        if not tag in self._elements:
+            if tag in self._unacceptable:
+                self.unacceptablestack -= 1
+            return
+        _HTMLSanitizer.unknown_endtag(self, tag)
+
+    def handle_entityref(self, ref):
+        if htmlentitydefs.name2codepoint.has_key(ref):
+            self.pieces.append('&%(ref)s;' % locals())
+        else:
+            self.pieces.append('&amp;%(ref)s' % locals())
+
+    def handle_comment(self, text):
+        _HTMLSanitizer.handle_comment(self, self._r_bareamp.sub("&amp;", text))
+
+    def handle_data(self, text):
+        if not self.unacceptablestack:
+            _HTMLSanitizer.handle_data(self, self._r_bareamp.sub("&amp;", text))
+
+def _find_tidy():
+    """Return a function to run markup through HTML Tidy, or None.
+
+    The first interface in PREFERRED_TIDY_INTERFACES that's installed is
+    used.  This is done when the module is imported and only done again
+    if PREFERRED_TIDY_INTERFACES is changed.
+    """
+    global _tidy, _tidy_interfaces
+    if _tidy_interfaces == PREFERRED_TIDY_INTERFACES:
+        return _tidy
+
+    _tidy = None
+    for tidy_interface in PREFERRED_TIDY_INTERFACES:
+        try:
+            if tidy_interface == "uTidy":
+                from tidy import parseString as _utidy
+                def _tidy(data, **kwargs):
+                    return str(_utidy(data, **kwargs))
+                break
+            elif tidy_interface == "mxTidy":
+                from mx.Tidy import Tidy as _mxtidy
+                def _tidy(data, **kwargs):
+                    nerrors, nwarnings, data, errordata = _mxtidy.tidy(data, **kwargs)
+                    return data
+                break
+        except:
+            pass
+    _tidy_interfaces = PREFERRED_TIDY_INTERFACES[:]
+    return _tidy
+
+_tidy = None
+_tidy_interfaces = None
+_find_tidy()
+
+_tidy_cache = {}
+
+def tidy_documents(documents):
+    """Run each of the documents through HTML Tidy, returning the results.
+
+    Only what's inside the body of each result is returned.  The results
+    are kept in memory keyed by a hash of the markup, so a document that
+    turns up again, in the same batch or a later one, isn't tidied again.
+    Without an HTML Tidy interface the documents are returned unchanged.
+    """
+    _tidy = _find_tidy()
+    if not _tidy:
+        return list(documents)
+
+    results = []
+    for data in documents:
+        utf8 = type(data) == type(u'')
+        if utf8:
+            data = data.encode('utf-8')
+
+        key = _md5(data).digest()
+        if _tidy_cache.has_key(key):
+            data = _tidy_cache[key]
+        else:
             data = _tidy(data, output_xhtml=1, numeric_entities=1, wrap=0, char_encoding="utf8")
-            if utf8:
-                data = unicode(data, 'utf-8')
-            if data.count('<body'):
-                data = data.split('<body', 1)[1]
-                if data.count('>'):
-                    data = data.split('>', 1)[1]
-            if data.count('</body'):
-                data = data.split('</body', 1)[0]
+            start = data.find('<body')
+            if start >= 0:
+                data = data[start + len('<body'):]
+                start = data.find('>')
+                if start >= 0:
+                    data = data[start + 1:]
+            end = data.find('</body')
+            if end >= 0:
+                data = data[:end]
+
+            if len(_tidy_cache) >= TIDY_CACHE_SIZE:
+                _tidy_cache.clear()
+            _tidy_cache[key] = data
+
+        if utf8:
+            data = unicode(data, 'utf-8')
+        results.append(data)
+    return results
+
+def _tidy_markup(data):
+    """Run the sanitized markup through HTML Tidy, if TIDY_MARKUP is set."""
+    if TIDY_MARKUP:
+        data = tidy_documents([data])[0]
     data = data.strip().replace('\r\n', '\n')
     return data
 
+def HTML(htmlSource, encoding='utf8', policy=None):
+    p = _HTMLSanitizer(encoding, policy)
+    p.feed(htmlSource)
+    return _tidy_markup(p.output())
+
+def feed_HTML(htmlSource, baseuri, encoding='utf8', policy=None):
+    """Resolve relative URIs in and sanitize markup from feedparser.
+
+    Gives the same result as HTML() did on markup feedparser had already
+    resolved and sanitized, with a third of the parsing.  Pass it as
+    feedparser.parse()'s html_processor to have feedparser use it instead.
+    A baseuri of None skips resolving, for markup feedparser's
+    _hasRelativeURIs() finds no relative URIs in.
+    """
+    p = _FeedHTMLSanitizer(encoding, baseuri, policy)
+    p.feed(htmlSource)
+    return _tidy_markup(p.output())
+
 unicode_bom_map = {
   '\x00\x00\xfe\xff': 'utf-32be',
   '\xff\xfe\x00\x00': 'utf-32le',
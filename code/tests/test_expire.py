@@ -0,0 +1,55 @@
+import os
+import md5
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import ConfigParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import planet
+from planet import feedparser
+
+
+def entry(id_, day):
+    """Return a feedparser entry of a few kilobytes from the given day."""
+    # Digests, so the summary doesn't compress much
+    summary = "".join([ md5.new("%s %d" % (id_, i)).hexdigest()
+                        for i in range(64) ])
+    return feedparser.FeedParserDict({
+        "id": id_,
+        "title": id_,
+        "summary": summary,
+        "updated_parsed": time.gmtime(1790000000 + day * 86400),
+        })
+
+class ExpireTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.planet = planet.Planet(ConfigParser.ConfigParser())
+        self.planet.cache_directory = self.directory
+        self.planet.cache_backend = "sqlite"
+        self.planet.cache_max_size = 6
+
+    def tearDown(self):
+        self.planet.cache_flush()
+        shutil.rmtree(self.directory)
+
+    def test_max_size_counts_ids_with_spaces(self):
+        channel = planet.Channel(self.planet, "http://example.com/feed")
+        channel.update_entries([ entry("tag:example.com,2026:post %d" % day,
+                                       day) for day in range(1, 6) ])
+        channel.cache_write()
+        # The feed only has the newest now, the rest are up for expiry
+        channel.update_entries([ entry("tag:example.com,2026:post 6", 6) ])
+        channel.cache_write()
+
+        self.assertEqual([ item.id for item in channel.items(sorted=1) ],
+                         ["tag:example.com,2026:post 6",
+                          "tag:example.com,2026:post 5"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import os
+import sys
+import glob
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from planet import feedparser, sanitize
+
+
+# Ill-formed feeds, parsed by the repair backend where it can fix them and by
+# the loose parser otherwise
+FEEDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "feeds")
+
+# Where the repair backend's result differs from the loose parser's, keyed by
+# feed, entry index (None for the feed itself) and key, with the loose
+# parser's value and then the repaired one.  Anything else must match.
+DIFFERENCES = {
+    # The loose parser leaves a reference in an element with no type
+    # undecoded and the text in the document's encoding
+    ("ill-formed-atom.xml", 0, "author"):
+        ("Fran\xc3\xa7ois &amp; Co", u"Fran\xe7ois & Co"),
+    # Control characters XML doesn't allow are dropped
+    ("ill-formed-atom.xml", 0, "content"):
+        (u'<p>Caf\xe9 &amp; bar\x01 <a href="/rel">link</a></p>',
+         u'<p>Caf\xe9 &amp; bar <a href="/rel">link</a></p>'),
+    ("ill-formed-atom.xml", 1, "summary"):
+        (u"Tom & Jerry\x0b \xa9 2026", u"Tom & Jerry \xa9 2026"),
+    # &nbsp; is decoded before leading and trailing whitespace is
+    # stripped, as &#160; always was, rather than after
+    ("ill-formed-atom.xml", 0, "summary"):
+        (u"AT&amp;T \xa0", u"AT&amp;T"),
+    # The loose parser turns a bare ampersand followed by a name into a
+    # reference by adding a semicolon
+    ("ill-formed-atom.xml", 0, "title"):
+        (u"AT&T; \xa0", u"AT&T"),
+    ("ill-formed-atom.xml", 1, "title"):
+        (u"a &c; x", u"a &c x"),
+    ("ill-formed-entities.xml", 0, "link"):
+        (u"http://b2.example.com/a?x=1&y;=2",
+         u"http://b2.example.com/a?x=1&y=2"),
+    }
+
+
+def parse_loose(data, html_processor=None):
+    """Parse the document as feedparser did before the repair backend."""
+    backends = feedparser.PREFERRED_PARSER_BACKENDS
+    feedparser.PREFERRED_PARSER_BACKENDS = ["strict"]
+    try:
+        return feedparser.parse(data, html_processor=html_processor)
+    finally:
+        feedparser.PREFERRED_PARSER_BACKENDS = backends
+
+def values(data):
+    """Return the values to compare of a feed or entry, by key."""
+    result = {}
+    for key, value in data.items():
+        if key == "content":
+            result[key] = value[0]["value"]
+        elif not key.endswith("_detail") and not key.endswith("_parsed") \
+                 and key not in ("links", "tags"):
+            result[key] = value
+    return result
+
+
+class RepairTest(unittest.TestCase):
+    def compare(self, html_processor=None):
+        for filename in glob.glob(os.path.join(FEEDS, "*.xml")):
+            data = open(filename).read()
+            name = os.path.basename(filename)
+            loose = parse_loose(data, html_processor)
+            repaired = feedparser.parse(data, html_processor=html_processor)
+
+            self.failUnless(repaired.bozo)
+            self.assertEqual(len(repaired.entries), len(loose.entries))
+            pairs = [ (None, loose.feed, repaired.feed) ]
+            for index in range(len(loose.entries)):
+                pairs.append((index, loose.entries[index],
+                              repaired.entries[index]))
+
+            for index, old, new in pairs:
+                old = values(old)
+                new = values(new)
+                keys = old.keys()
+                keys.sort()
+                new_keys = new.keys()
+                new_keys.sort()
+                self.assertEqual(keys, new_keys)
+                for key in old.keys():
+                    expected = DIFFERENCES.get((name, index, key),
+                                               (old[key], old[key]))
+                    self.assertEqual((old[key], new[key]), expected,
+                                     "%s %s %s" % (name, index, key))
+
+    def test_same_as_loose_parser(self):
+        self.compare()
+
+    def test_same_as_loose_parser_with_html_processor(self):
+        self.compare(sanitize.feed_HTML)
+
+    def test_repaired_html_escapes_ampersands(self):
+        data = open(os.path.join(FEEDS, "ill-formed-atom.xml")).read()
+        entry = feedparser.parse(data).entries[0]
+        self.assertEqual(entry.summary, u"AT&amp;T")
+        self.assertEqual(entry.content[0].value,
+                         u'<p>Caf\xe9 &amp; bar <a href="/rel">link</a></p>')
+
+
+if __name__ == "__main__":
+    unittest.main()
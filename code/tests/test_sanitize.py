@@ -0,0 +1,126 @@
+import os
+import sys
+import glob
+import unittest
+import ConfigParser
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import planet
+from planet import feedparser, sanitize
+
+
+# Blocks of HTML from feeds, each parsed from the summary of an entry
+BLOCKS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "html")
+
+BLOCK_FEED = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xml:base="http://example.com/blog/post/">
+  <title>Feed</title>
+  <entry><id>1</id><title>Entry</title>
+    <summary type="html">%s</summary>
+  </entry>
+</feed>"""
+
+# Where feed_HTML's result differs from the three passes it replaces, keyed
+# by block, with the old result and then the new one.  Anything else must
+# match.
+DIFFERENCES = {
+    # References in attribute values were unescaped by each pass, so the
+    # quotes they turned into ended the value early
+    "escaped-attributes.html":
+        ('<a href="http://example.com/blog/post/rel/page?x=1&y=2" '
+         'title="a ">link</a>'
+         '<img src="http://example.com/img.png" alt="x/" />',
+         '<a href="http://example.com/blog/post/rel/page?x=1&y=2" '
+         'title="a &quot;q&quot;">link</a>'
+         '<img src="http://example.com/img.png" alt="x/" />'),
+    # and the brackets they turned into were parsed as markup again
+    "escaped-brackets.html":
+        ('<p title="x>y">y">y">gt in attr</p><p title="a<b"><b>lt</b></p>',
+         '<p title="x>y">y">gt in attr</p><p title="a<b">lt</p>'),
+    }
+
+
+class PolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = sanitize.Policy(['p', 'a', 'script', 'style', 'applet'],
+                                      ['href'])
+
+    def test_ignorable_elements_not_allowed(self):
+        for element in sanitize._HTMLSanitizer.ignorable_elements:
+            self.failIf(self.policy.elements.has_key(element))
+
+    def test_same_version_as_without_them(self):
+        self.assertEqual(self.policy.version,
+                         sanitize.Policy(['p', 'a'], ['href']).version)
+
+    def test_feed_HTML_drops_allowed_script(self):
+        html = sanitize.feed_HTML('<p>hi<script>alert(1)</script></p>',
+                                  'http://example.org/', policy=self.policy)
+        self.assertEqual(html, '<p>hi</p>')
+
+    def test_feed_HTML_drops_allowed_applet_and_style(self):
+        html = sanitize.feed_HTML('<p><applet code="x">a</applet>'
+                                  '<style>b</style></p>',
+                                  'http://example.org/', policy=self.policy)
+        self.failIf('<applet' in html or '<style' in html)
+
+    def test_HTML_drops_allowed_script(self):
+        html = sanitize.HTML('<p>hi<script>alert(1)</script></p>',
+                             policy=self.policy)
+        self.assertEqual(html, '<p>hi</p>')
+
+
+FEED = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Feed</title>
+  <entry><id>1</id><title>One</title>
+    <summary type="html">&lt;p&gt;&lt;b&gt;bold&lt;/b&gt;&lt;/p&gt;</summary>
+  </entry>
+  <entry><id>2</id><title>Two</title>
+    <summary type="html">&lt;p&gt;&lt;b&gt;bold&lt;/b&gt;&lt;/p&gt;</summary>
+  </entry>
+</feed>"""
+
+class HTMLProcessorTest(unittest.TestCase):
+    def planet(self, elements):
+        my_planet = planet.Planet(ConfigParser.ConfigParser())
+        my_planet.html_policy = sanitize.Policy(elements, [])
+        return my_planet
+
+    def test_only_used_by_its_parse(self):
+        processed = feedparser.parse(FEED,
+            html_processor=lambda html, baseuri, encoding: u"processed")
+        self.assertEqual(processed.entries[0].summary, u"processed")
+        self.assertEqual(feedparser.parse(FEED).entries[0].summary,
+                         u"<p><b>bold</b></p>")
+
+    def test_each_planet_its_own_policy(self):
+        with_b = self.planet(["p", "b"])
+        without_b = self.planet(["p"])
+        first = feedparser.iterparse(FEED, html_processor=with_b.sanitize,
+            html_processor_version=with_b.sanitize_version())
+        second = feedparser.parse(FEED, html_processor=without_b.sanitize,
+            html_processor_version=without_b.sanitize_version())
+        self.assertEqual([ entry.summary for entry in first.entries ],
+                         [u"<p><b>bold</b></p>"] * 2)
+        self.assertEqual(second.entries[0].summary, u"<p>bold</p>")
+        self.assertNotEqual(with_b.sanitize_version(),
+                            without_b.sanitize_version())
+
+    def test_same_as_three_passes(self):
+        my_planet = planet.Planet(ConfigParser.ConfigParser())
+        for filename in glob.glob(os.path.join(BLOCKS, "*.html")):
+            name = os.path.basename(filename)
+            feed = BLOCK_FEED % escape(open(filename).read())
+            old = sanitize.HTML(feedparser.parse(feed).entries[0].summary)
+            new = feedparser.parse(feed, html_processor=my_planet.sanitize,
+                html_processor_version=my_planet.sanitize_version())
+            new = new.entries[0].summary.encode("utf-8")
+            expected = DIFFERENCES.get(name, (old, old))
+            self.assertEqual((old, new), expected, name)
+
+
+if __name__ == "__main__":
+    unittest.main()